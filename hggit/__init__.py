@@ -34,7 +34,7 @@ demandimport.ignore.extend([
     ])
 
 import gitrepo, hgrepo
-from git_handler import GitHandler
+from git_handler import gethandler
 
 # support for `hg clone git://github.com/defunkt/facebox.git`
 # also hg clone git+ssh://git@github.com/schacon/simplegit.git
@@ -90,7 +90,6 @@ if getattr(hg, 'addbranchrevs', False):
 
 changeset_re = None # Cached regular expression for a changeset string
 cached_repo = None  # Cached copy of the repo sent to reposetup
-cached_git = None   # Cached githandler for cached_repo
 
 def uisetup(ui):
     class ext_ui(ui.__class__):
@@ -100,7 +99,6 @@ def uisetup(ui):
             # Changesets are printed twice in the current hg code, always with label log.changeset
             if kwargs.has_key('label') and kwargs['label'] == 'log.changeset' and len(args) and cached_repo:
                 global changeset_re
-                global cached_git
                 if not changeset_re:
                     changeset_re = re.compile('(\d+):\w+(\s*)$')
                 match = changeset_re.search(args[0])
@@ -117,9 +115,8 @@ def uisetup(ui):
                     hgsha = cached_repo.lookup(int(rev)) # Ints are efficient on lookup
                     if (hgsha):
                         hgsha = hexfilter(hgsha)
-                        if not cached_git:
-                            cached_git = GitHandler(cached_repo, self)
-                        gitsha = cached_git.map_git_get(hgsha)
+                        git = gethandler(cached_repo, self)
+                        gitsha = git.map_git_get(hgsha)
                     else: # Currently this case is hit when you do hg outgoing. I'm not sure why.
                         gitsha = None
                     
@@ -141,33 +138,36 @@ def reposetup(ui, repo):
     cached_repo = repo
 
 def gimport(ui, repo, remote_name=None):
-    git = GitHandler(repo, ui)
+    git = gethandler(repo, ui)
     git.import_commits(remote_name)
 
 def gexport(ui, repo):
-    git = GitHandler(repo, ui)
+    git = gethandler(repo, ui)
     git.export_commits()
 
 def gclear(ui, repo):
     repo.ui.status(_("clearing out the git cache data\n"))
-    git = GitHandler(repo, ui)
+    git = gethandler(repo, ui)
     git.clear()
 	
 def gsummary(ui, repo):
     ctx = repo[None]
     parents = ctx.parents()
-    git = GitHandler(repo, ui)
+    git = gethandler(repo, ui)
     for p in parents:
         repo.ui.status(_('git-rev: %s\n') % git.map_git_get(p.hex()))
 
 def git_cleanup(ui, repo):
-    new_map = []
-    for line in repo.opener(GitHandler.mapfile):
-        gitsha, hgsha = line.strip().split(' ', 1)
-        if hgsha in repo:
-            new_map.append('%s %s\n' % (gitsha, hgsha))
-    f = repo.opener(GitHandler.mapfile, 'wb')
-    map(f.write, new_map)
+    git = gethandler(repo, ui)
+    git._map.compact(keep=lambda gitsha, hgsha: hgsha in repo)
+    if os.path.exists(git.gitdir):
+        # drop cached trees and blobs that git itself has since pruned
+        git.init_if_missing()
+        store = git.git.object_store
+        git.treemap.compact(keep=lambda treesha, mnode: treesha in store)
+        git.blobmap.compact(keep=lambda blobsha, filenode: blobsha in store)
+        # and fold the commit graph journal into the graph file
+        git.graph.compact()
     ui.status(_('git commit map cleaned\n'))
 
 # drop this when we're 1.6-only, this just backports new behavior
@@ -196,7 +196,7 @@ try:
             kw.update(kwargs)
             for val, k in zip(args, ('base', kwname, 'force')):
                 kw[k] = val
-            git = GitHandler(local, local.ui)
+            git = gethandler(local, local.ui)
             base, heads = git.get_refs(remote.path)
             newkw = {'base': base, kwname: heads}
             newkw.update(kw)
@@ -222,7 +222,7 @@ def getremotechanges(orig, ui, repo, other, *args, **opts):
             revs = args[0]
         else:
             revs = opts.get('onlyheads', opts.get('revs'))
-        git = GitHandler(repo, ui)
+        git = gethandler(repo, ui)
         r, c, cleanup = git.getremotechanges(other, revs)
         # ugh. This is ugly even by mercurial API compatibility standards
         if 'onlyheads' not in orig.func_code.co_varnames:
@@ -1,15 +1,90 @@
+import atexit
+import os
+import stat
+import tempfile
+
 from mercurial import util
 
 class SSHVendor(object):
     """Parent class for ui-linked Vendor classes."""
 
 
+def _controldir():
+    """Return a directory only we can use for ssh control sockets, or None
+    if there is none."""
+    if os.name != 'posix':
+        return None
+    uid = os.getuid()
+    path = os.path.join(tempfile.gettempdir(), 'hg-git-ssh-%d' % uid)
+    try:
+        os.mkdir(path, 0700)
+    except OSError:
+        pass
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    # anyone else who could get at the sockets could use our connections
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != uid
+        or st.st_mode & 077):
+        return None
+    return path
+
+# how long a master started for one process alone stays up after its last
+# session ends, in case the process dies without closing it
+_ORPHANPERSIST = 60
+
+def _multiplexopts(ui, sshcmd, host, username=None, port=None):
+    """Return the ssh options sharing one connection per host, or ''.
+
+    Only OpenSSH knows about control masters. Unless git.sshpersist asks
+    to keep masters around for that many seconds, where other processes
+    may use them too, each process has masters of its own, which are
+    closed when it exits.
+    """
+    if not ui.configbool('git', 'sshmultiplex', True):
+        return ''
+    if os.path.basename(sshcmd.split()[0]) != 'ssh':
+        return ''
+    controldir = _controldir()
+    if controldir is None:
+        return ''
+    persist = ui.configint('git', 'sshpersist', 0)
+    # control sockets must fit in a unix socket address, about 100 bytes,
+    # so name them by a digest of the destination (ssh's own %C token
+    # needs OpenSSH 6.7)
+    name = util.sha1('%s@%s:%s' % (username or '', host,
+                                   port or '')).hexdigest()[:16]
+    if persist <= 0:
+        name = '%d-%s' % (os.getpid(), name)
+        persist = _ORPHANPERSIST
+    return '-o ControlMaster=auto -o %s -o ControlPersist=%d' % (
+        util.shellquote('ControlPath=' + os.path.join(controldir, name)),
+        persist)
+
 def generate_ssh_vendor(ui):
     """
     Allows dulwich to use hg's ui.ssh config. The dulwich.client.get_ssh_vendor
     property should point to the return value.
     """
 
+    # masters started for this process, to close on exit
+    masters = set()
+
+    def closemasters():
+        import subprocess
+        for cmd in masters:
+            ui.debug('closing ssh master: %s\n' % cmd)
+            devnull = open(os.devnull, 'w')
+            try:
+                subprocess.call(util.quotecommand(cmd), shell=True,
+                                stdout=devnull, stderr=devnull)
+            finally:
+                devnull.close()
+        masters.clear()
+
+    atexit.register(closemasters)
+
     class _Vendor(SSHVendor):
         def connect_ssh(self, host, command, username=None, port=None):
             from dulwich.client import SubprocessWrapper
@@ -18,10 +93,14 @@ def generate_ssh_vendor(ui):
 
             sshcmd = ui.config("ui", "ssh", "ssh")
             args = util.sshargs(sshcmd, host, username, port)
-            cmd = '%s %s %s' % (sshcmd, args, 
+            opts = _multiplexopts(ui, sshcmd, host, username, port)
+            if opts:
+                sshcmd = '%s %s' % (sshcmd, opts)
+                if ui.configint('git', 'sshpersist', 0) <= 0:
+                    masters.add('%s -O exit %s' % (sshcmd, args))
+            cmd = '%s %s %s' % (sshcmd, args,
                                 util.shellquote(' '.join(command)))
             ui.debug('calling ssh: %s\n' % cmd)
-            print command
             proc = subprocess.Popen(util.quotecommand(cmd), shell=True,
                                     stdin=subprocess.PIPE,
                                     stdout=subprocess.PIPE)
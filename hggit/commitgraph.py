@@ -0,0 +1,347 @@
+# commit graph cache for the git object store
+#
+# For every commit hg-git has seen, the graph file keeps its parents, its
+# commit time and its generation number (one more than the highest
+# generation of its parents), so history can be walked and ancestry
+# checked without inflating commit objects.
+#
+# Layout, all integers big endian:
+#   magic (8 bytes) | count (4 bytes) | extracount (4 bytes)
+#   count records, in topological order (parents before children):
+#     SHA (20 bytes) | commit time (8) | commit timezone (4) |
+#     generation (4) | first parent (4) | second parent (4)
+#   extracount parent indexes (4 bytes each) for octopus merges
+#   count record indexes (4 bytes each), sorted by SHA
+#
+# Parents are stored as record indexes, -1 meaning no parent. A second
+# parent of -2 - n means the commit has more than two parents: extra
+# entry n holds how many more there are, and they follow it.
+#
+# A commit with a parent the graph does not know, such as one at the edge
+# of a shallow clone, has the generation UNKNOWN, and so do all of its
+# descendants; the parent itself is left out.
+#
+# New commits are appended to a journal file next to the graph, each as
+# its record followed, for an octopus merge, by its extra parent entries.
+# Record indexes go on from the last record of the graph file, so readers
+# replay the journal on top of it. compact() merges the journal into the
+# graph file.
+
+import binascii
+import bisect
+import mmap
+import os
+import struct
+
+from mercurial import util as hgutil
+
+MAGIC = 'HGGITCG1'
+_HEADER = struct.Struct('>8sLL')
+_RECORD = struct.Struct('>20sqlLll')
+_INT = struct.Struct('>l')
+UNKNOWN = 0xffffffff
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+class _sortedshas(object):
+    """Sequence view of the record SHAs in the file's sorted order."""
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __len__(self):
+        return self.graph._count
+
+    def __getitem__(self, i):
+        return self.graph._sha(self.graph._sorted(i))
+
+class commitgraph(object):
+    """Parents, commit times and generation numbers of git commits.
+
+    SHAs are passed in and returned as 40-character hex strings. Commits
+    added with add() are kept in memory until save() appends them to the
+    journal; a commit must be added after all of its parents that are
+    available, or it is taken to have unknown history.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.journalpath = path + '.journal'
+        self._file = None
+        self._data = ''
+        self._stamp = None
+        self.load()
+
+    def load(self):
+        self.close()
+        self._count = 0
+        self._extracount = 0
+        self._new = []
+        self._newextra = []
+        self._newindex = {}
+        self._saved = 0
+        self._unsaved = []
+        self._journalsize = 0
+        self._stamp = _stat(self.path)
+        if self._stamp and self._stamp[0] > _HEADER.size:
+            self._file = open(self.path, 'rb')
+            self._data = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            magic, self._count, self._extracount = _HEADER.unpack_from(
+                self._data, 0)
+            if magic != MAGIC:
+                # unknown format; start over
+                self.close()
+                self._count = self._extracount = 0
+                if os.path.exists(self.journalpath):
+                    os.remove(self.journalpath)
+                return
+            self._extraoffset = _HEADER.size + self._count * _RECORD.size
+            self._sortedoffset = self._extraoffset + self._extracount * 4
+        self._loadjournal()
+
+    def _loadjournal(self):
+        if not os.path.exists(self.journalpath):
+            return
+        f = open(self.journalpath, 'rb')
+        data = f.read()
+        f.close()
+        pos = 0
+        while pos + _RECORD.size <= len(data):
+            record = _RECORD.unpack_from(data, pos)
+            end = pos + _RECORD.size
+            if record[5] <= -2:
+                if end + 4 > len(data):
+                    break
+                count = _INT.unpack_from(data, end)[0]
+                if end + 4 + count * 4 > len(data):
+                    break
+                extra = [_INT.unpack_from(data, end + 4 + k * 4)[0]
+                         for k in range(count)]
+                end += 4 + count * 4
+                record = record[:5] + (
+                    -2 - (self._extracount + len(self._newextra)),)
+                self._newextra.append(count)
+                self._newextra.extend(extra)
+            self._newindex[record[0]] = len(self)
+            self._new.append(record)
+            pos = end
+        self._saved = len(self._new)
+        self._journalsize = pos
+        if pos != len(data):
+            # drop the torn entry left by an interrupted save, so that
+            # later appends stay aligned
+            try:
+                f = open(self.journalpath, 'r+b')
+                f.truncate(pos)
+                f.close()
+            except (IOError, OSError):
+                pass
+
+    def changed(self):
+        """Tell whether the files were written by someone else since load."""
+        if _stat(self.path) != self._stamp:
+            return True
+        journal = _stat(self.journalpath)
+        return (journal and journal[0] or 0) != self._journalsize
+
+    def close(self):
+        if self._file is not None:
+            self._data.close()
+            self._file.close()
+        self._file = None
+        self._data = ''
+
+    def __len__(self):
+        return self._count + len(self._new)
+
+    # index based accessors
+
+    def _record(self, i):
+        if i < self._count:
+            return _RECORD.unpack_from(self._data,
+                                       _HEADER.size + i * _RECORD.size)
+        return self._new[i - self._count]
+
+    def _sha(self, i):
+        return self._record(i)[0]
+
+    def _sorted(self, i):
+        return _INT.unpack_from(self._data, self._sortedoffset + i * 4)[0]
+
+    def _extra(self, n):
+        if n < self._extracount:
+            return _INT.unpack_from(self._data, self._extraoffset + n * 4)[0]
+        return self._newextra[n - self._extracount]
+
+    def _index(self, binsha):
+        i = self._newindex.get(binsha)
+        if i is not None:
+            return i
+        shas = _sortedshas(self)
+        pos = bisect.bisect_left(shas, binsha)
+        if pos < self._count and shas[pos] == binsha:
+            return self._sorted(pos)
+        return None
+
+    def _parents(self, i):
+        record = self._record(i)
+        p1, p2 = record[4], record[5]
+        if p1 < 0:
+            return []
+        if p2 == -1:
+            return [p1]
+        if p2 >= 0:
+            return [p1, p2]
+        n = -2 - p2
+        return [p1] + [self._extra(n + 1 + k) for k in range(self._extra(n))]
+
+    def _generation(self, i):
+        return self._record(i)[3]
+
+    # SHA based interface
+
+    def __contains__(self, sha):
+        return self._index(binascii.unhexlify(sha)) is not None
+
+    def parents(self, sha):
+        i = self._index(binascii.unhexlify(sha))
+        return [binascii.hexlify(self._sha(p)) for p in self._parents(i)]
+
+    def committime(self, sha):
+        """Return (commit time, commit timezone) of a commit."""
+        record = self._record(self._index(binascii.unhexlify(sha)))
+        return record[1], record[2]
+
+    def generation(self, sha):
+        """Return the generation of a commit, or UNKNOWN if some of its
+        history is missing from the graph."""
+        return self._generation(self._index(binascii.unhexlify(sha)))
+
+    def add(self, sha, parents, time, timezone):
+        binsha = binascii.unhexlify(sha)
+        if self._index(binsha) is not None:
+            return
+        pidx = [self._index(binascii.unhexlify(p)) for p in parents]
+        generations = [p is not None and self._generation(p) or UNKNOWN
+                       for p in pidx]
+        if UNKNOWN in generations:
+            generation = UNKNOWN
+        else:
+            generation = 1 + max(generations or [0])
+        pidx = [p for p in pidx if p is not None]
+        p1 = p2 = -1
+        if pidx:
+            p1 = pidx[0]
+        if len(pidx) == 2:
+            p2 = pidx[1]
+        elif len(pidx) > 2:
+            p2 = -2 - (self._extracount + len(self._newextra))
+            self._newextra.append(len(pidx) - 1)
+            self._newextra.extend(pidx[1:])
+        self._newindex[binsha] = len(self)
+        self._new.append((binsha, time, timezone, generation, p1, p2))
+        self._unsaved.append((sha, parents, time, timezone))
+
+    def isancestor(self, ancestor, descendant):
+        """Tell whether ancestor is descendant or one of its ancestors.
+
+        Returns None if the graph cannot tell, because ancestor was not
+        found and some of the history of descendant is missing.
+        """
+        a = self._index(binascii.unhexlify(ancestor))
+        d = self._index(binascii.unhexlify(descendant))
+        if a == d:
+            return True
+        generation = self._generation(a)
+        if generation == UNKNOWN:
+            # then so is the generation of all of its descendants
+            if self._generation(d) != UNKNOWN:
+                return False
+            generation = 0
+        seen = set([d])
+        visit = [d]
+        while visit:
+            i = visit.pop()
+            # parents always have a lower generation than their children,
+            # so nothing below the ancestor's generation can lead to it
+            g = self._generation(i)
+            if g != UNKNOWN and g <= generation:
+                continue
+            for p in self._parents(i):
+                if p == a:
+                    return True
+                if p not in seen:
+                    seen.add(p)
+                    visit.append(p)
+        if self._generation(d) == UNKNOWN:
+            return None
+        return False
+
+    def save(self):
+        """Append the commits added since the last save to the journal."""
+        if self._saved == len(self._new):
+            return
+        if self.changed():
+            # someone else wrote to the graph, so the record indexes of our
+            # new commits may be taken: add them again on top of theirs
+            pending = self._unsaved
+            self.load()
+            for args in pending:
+                self.add(*args)
+        data = []
+        for record in self._new[self._saved:]:
+            data.append(_RECORD.pack(*record))
+            if record[5] <= -2:
+                n = -2 - record[5]
+                count = self._extra(n)
+                for k in xrange(count + 1):
+                    data.append(_INT.pack(self._extra(n + k)))
+        data = ''.join(data)
+        f = open(self.journalpath, 'ab')
+        f.write(data)
+        f.close()
+        self._journalsize += len(data)
+        self._saved = len(self._new)
+        self._unsaved = []
+
+    def compact(self):
+        """Merge the journal and any new commits into the graph file."""
+        self.save()
+        if not self._new:
+            return
+        count = len(self)
+        extracount = self._extracount + len(self._newextra)
+        file = hgutil.atomictempfile(self.path, 'wb')
+        file.write(_HEADER.pack(MAGIC, count, extracount))
+        if self._count:
+            file.write(self._data[_HEADER.size:self._extraoffset])
+        for record in self._new:
+            file.write(_RECORD.pack(*record))
+        if self._extracount:
+            file.write(self._data[self._extraoffset:self._sortedoffset])
+        for n in self._newextra:
+            file.write(_INT.pack(n))
+        # merge the sorted table with the new commits
+        new = sorted(self._newindex.iteritems())
+        shas = _sortedshas(self)
+        j = 0
+        for pos in xrange(self._count):
+            sha = shas[pos]
+            while j < len(new) and new[j][0] < sha:
+                file.write(_INT.pack(new[j][1]))
+                j += 1
+            file.write(_INT.pack(self._sorted(pos)))
+        for sha, i in new[j:]:
+            file.write(_INT.pack(i))
+        self.close()
+        # If this complains that NoneType is not callable, then
+        # atomictempfile no longer has either of rename (pre-1.9) or
+        # close (post-1.9)
+        getattr(file, 'rename', getattr(file, 'close', None))()
+        if os.path.exists(self.journalpath):
+            os.remove(self.journalpath)
+        self.load()
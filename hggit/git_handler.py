@@ -1,5 +1,10 @@
-import os, math, urllib, re
+import os, math, stat, urllib, re, time
+import collections
+import heapq
+import inspect
+import tempfile
 
+from dulwich.diff_tree import tree_changes
 from dulwich.errors import HangupException, GitProtocolError
 from dulwich.index import commit_tree
 from dulwich.objects import Blob, Commit, Tag, Tree, parse_timezone
@@ -17,6 +22,11 @@ try:
     from mercurial.error import RepoError
 except ImportError:
     from mercurial.repo import RepoError
+try:
+    from multiprocessing.pool import ThreadPool
+except ImportError:
+    # no working threads or semaphores on this platform
+    ThreadPool = None
 
 from mercurial.i18n import _
 from mercurial.node import hex, bin, nullid
@@ -26,6 +36,11 @@ from mercurial import error
 import _ssh
 import util
 from overlay import overlayrepo
+from gitmap import gitmap
+from commitgraph import commitgraph
+from packwriter import packwriter, writepack
+from objectcache import objectcache
+from objectfilter import objectfilter
 
 class GitProgress(object):
     """convert git server progress strings into mercurial progress"""
@@ -67,9 +82,55 @@ class GitProgress(object):
         if msg:
             self.ui.note(msg + '\n')
 
+def _cpucount():
+    if ThreadPool is None:
+        return 1
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def _makeblob(data):
+    """Build a blob and compute its SHA; safe to run in a worker thread.
+
+    hashlib releases the GIL while hashing large buffers, so several of
+    these run in parallel.
+    """
+    blob = Blob.from_string(data)
+    blob.id
+    return blob
+
+# GitHandler instances shared by everything running in this process,
+# keyed by repository path
+_handlers = {}
+
+def gethandler(repo, ui):
+    """Return the GitHandler for repo, shared across callers in-process.
+
+    The handler is built once per repository and only reloads its state
+    when the map, tags or remote refs files change on disk.
+    """
+    handler = _handlers.get(repo.path)
+    if handler is None:
+        handler = _handlers[repo.path] = GitHandler(repo, ui)
+    else:
+        handler.repo = repo
+        handler.ui = ui
+        handler.paths = ui.configitems('paths')
+        handler.refresh()
+    return handler
+
 class GitHandler(object):
     mapfile = 'git-mapfile'
     tagsfile = 'git-tags'
+    remoterefsfile = 'git-remote-refs'
+    graphfile = 'hg-git-commit-graph'
+    treemapfile = 'hg-git-tree-map'
+    blobmapfile = 'hg-git-blob-map'
+    filterfile = 'hg-git-object-filter'
+    exportedfile = 'git-exported'
+    lsremotefile = 'git-ls-remote'
 
     def __init__(self, dest_repo, ui):
         self.repo = dest_repo
@@ -81,9 +142,28 @@ class GitHandler(object):
             self.gitdir = self.repo.join('git')
 
         self.paths = ui.configitems('paths')
+        # how many commits to convert between journal flushes of the map
+        self.mapflush = ui.configint('git', 'mapflush', 100)
+        self.graph = None
+        # git trees we built for hg manifests, by manifest node
+        self.treemap = None
+        # recently written or read trees, by SHA
+        self._subtrees = {}
+        # git blobs written for hg file revisions, by filenode
+        self.blobmap = None
+        # recently read commits and trees
+        self.objects = None
+        # collects the objects written by an export when packing them
+        self._packwriter = None
+        # hashes and compresses new blobs during an export
+        self._pool = None
+        self._exportthreads = 1
+        # hg tags exported as git tags, by name
+        self.exportedtags = {}
 
         self.load_map()
         self.load_tags()
+        self.load_remote_refs()
 
     # make the git data directory
     def init_if_missing(self):
@@ -92,39 +172,106 @@ class GitHandler(object):
         else:
             os.mkdir(self.gitdir)
             self.git = Repo.init_bare(self.gitdir)
+        # objects never change, so the cache outlives the Repo instance
+        if self.objects is None:
+            self.objects = objectcache(
+                self.git.object_store,
+                self.ui.configint('git', 'commitcache', 10000),
+                self.ui.configint('git', 'treecache', 1000),
+                self.ui.configint('git', 'deltabasecache', 32) << 20)
+        else:
+            self.objects.store = self.git.object_store
+        # an in-tree repository is shared with git, which may add objects
+        # in ways the filter does not follow, such as alternates
+        if not self.ui.configbool('git', 'intree'):
+            filterpath = os.path.join(self.gitdir, self.filterfile)
+            if (self.objects.filter is None
+                or self.objects.filter.path != filterpath):
+                self.objects.filter = objectfilter(filterpath,
+                                                   self.git.object_store)
+            else:
+                self.objects.filter.store = self.git.object_store
+                # pick up the packs other processes added since it was loaded
+                self.objects.filter.refresh()
+        graphpath = os.path.join(self.gitdir, self.graphfile)
+        if (self.graph is None or self.graph.path != graphpath
+            or self.graph.changed()):
+            self.graph = commitgraph(graphpath)
+        treemappath = os.path.join(self.gitdir, self.treemapfile)
+        if self.treemap is None or self.treemap.path != treemappath:
+            self.treemap = gitmap(treemappath)
+            self._subtrees = {}
+        elif self.treemap.changed():
+            self.treemap.reload()
+        blobmappath = os.path.join(self.gitdir, self.blobmapfile)
+        if self.blobmap is None or self.blobmap.path != blobmappath:
+            self.blobmap = gitmap(blobmappath)
+        elif self.blobmap.changed():
+            self.blobmap.reload()
 
     ## FILE LOAD AND SAVE METHODS
 
+    def _filestamp(self, name):
+        try:
+            st = os.stat(self.repo.join(name))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def refresh(self):
+        """Reload whatever was changed on disk by another process."""
+        if self._map.changed():
+            self._map.reload()
+        if self._filestamp(self.tagsfile) != self._tagsstamp:
+            self.load_tags()
+        if self._filestamp(self.remoterefsfile) != self._remoterefsstamp:
+            self.load_remote_refs()
+
     def map_set(self, gitsha, hgsha):
-        self._map_git[gitsha] = hgsha
-        self._map_hg[hgsha] = gitsha
+        self._map.set(gitsha, hgsha)
 
     def map_hg_get(self, gitsha):
-        return self._map_git.get(gitsha)
+        return self._map.hg(gitsha)
 
     def map_git_get(self, hgsha):
-        return self._map_hg.get(hgsha)
+        return self._map.git(hgsha)
 
     def load_map(self):
-        self._map_git = {}
-        self._map_hg = {}
-        if os.path.exists(self.repo.join(self.mapfile)):
-            for line in self.repo.opener(self.mapfile):
-                gitsha, hgsha = line.strip().split(' ', 1)
-                self._map_git[gitsha] = hgsha
-                self._map_hg[hgsha] = gitsha
+        self._map = gitmap(self.repo.join(self.mapfile),
+                           self.ui.configint('git', 'mapcompact', 10000))
 
     def save_map(self):
-        file = self.repo.opener(self.mapfile, 'w+', atomictemp=True)
-        for hgsha, gitsha in sorted(self._map_hg.iteritems()):
-            file.write("%s %s\n" % (gitsha, hgsha))
-        # If this complains that NoneType is not callable, then
-        # atomictempfile no longer has either of rename (pre-1.9) or
-        # close (post-1.9)
-        getattr(file, 'rename', getattr(file, 'close', None))()
+        self._map.save()
+        if self.graph is not None:
+            self.graph.save()
+        if self.treemap is not None:
+            self.treemap.save()
+        if self.blobmap is not None:
+            self.blobmap.save()
+        if self.objects is not None and self.objects.filter is not None:
+            self.objects.filter.save()
+
+    def flush_maps(self):
+        """Append the new entries of the map and the export caches to their
+        journals.
+        """
+        self._map.flush()
+        if self.treemap is not None:
+            self.treemap.flush()
+        if self.blobmap is not None:
+            self.blobmap.flush()
+
+    def blob_get(self, filenode):
+        """Return the git blob SHA for an hg filenode, or None."""
+        blobid = self.blobmap.git(filenode)
+        if blobid is None:
+            # older versions kept blobs in the commit map
+            blobid = self.map_git_get(filenode)
+        return blobid
 
     def load_tags(self):
         self.tags = {}
+        self._tagsstamp = self._filestamp(self.tagsfile)
         if os.path.exists(self.repo.join(self.tagsfile)):
             for line in self.repo.opener(self.tagsfile):
                 sha, name = line.strip().split(' ', 1)
@@ -139,6 +286,90 @@ class GitHandler(object):
         # atomictempfile no longer has either of rename (pre-1.9) or
         # close (post-1.9)
         getattr(file, 'rename', getattr(file, 'close', None))()
+        self._tagsstamp = self._filestamp(self.tagsfile)
+
+    def load_remote_refs(self):
+        self.remote_refs = {}
+        self._remoterefsstamp = self._filestamp(self.remoterefsfile)
+        if os.path.exists(self.repo.join(self.remoterefsfile)):
+            for line in self.repo.opener(self.remoterefsfile):
+                sha, name = line.strip().split(' ', 1)
+                self.remote_refs[name] = bin(sha)
+
+    def save_remote_refs(self):
+        tf = self.repo.opener(self.remoterefsfile, 'wb')
+        for tag, node in self.remote_refs.iteritems():
+            tf.write('%s %s\n' % (hex(node), tag))
+        tf.close()
+        self._remoterefsstamp = self._filestamp(self.remoterefsfile)
+
+    def load_exported(self):
+        """Return the rev up to which all changesets have been exported.
+
+        Returns -1 if nothing is known to be exported, or if a strip has
+        removed or renumbered that rev since it was recorded.
+        """
+        try:
+            rev, node = self.repo.opener(self.exportedfile).read().split()
+            rev = int(rev)
+        except (IOError, ValueError):
+            return -1
+        if rev >= len(self.repo) or hex(self.repo.changelog.node(rev)) != node:
+            return -1
+        return rev
+
+    def save_exported(self, rev):
+        file = self.repo.opener(self.exportedfile, 'w+', atomictemp=True)
+        file.write('%d %s\n' % (rev, hex(self.repo.changelog.node(rev))))
+        # If this complains that NoneType is not callable, then
+        # atomictempfile no longer has either of rename (pre-1.9) or
+        # close (post-1.9)
+        getattr(file, 'rename', getattr(file, 'close', None))()
+
+    def load_ls_remote(self, uri):
+        """Return the refs uri advertised less than git.lsremotettl
+        seconds ago, or None if they are not known."""
+        ttl = self.ui.configint('git', 'lsremotettl', 0)
+        if ttl <= 0:
+            return None
+        key = urllib.quote(uri, '')
+        now = time.time()
+        refs = None
+        try:
+            lines = self.repo.opener(self.lsremotefile).read().splitlines()
+        except IOError:
+            return None
+        for line in lines:
+            k, stamp, sha, ref = line.split(' ', 3)
+            if k == key and 0 <= now - float(stamp) <= ttl:
+                if refs is None:
+                    refs = {}
+                refs[ref] = sha
+        return refs
+
+    def save_ls_remote(self, uri, refs):
+        """Remember the refs uri advertised; None forgets them."""
+        ttl = self.ui.configint('git', 'lsremotettl', 0)
+        if refs is not None and ttl <= 0:
+            return
+        key = urllib.quote(uri, '')
+        try:
+            lines = self.repo.opener(self.lsremotefile).read().splitlines()
+        except IOError:
+            if refs is None:
+                return
+            lines = []
+        file = self.repo.opener(self.lsremotefile, 'w+', atomictemp=True)
+        for line in lines:
+            if line.split(' ', 1)[0] != key:
+                file.write(line + '\n')
+        stamp = time.time()
+        for ref, sha in sorted((refs or {}).iteritems()):
+            file.write('%s %f %s %s\n' % (key, stamp, sha, ref))
+        # If this complains that NoneType is not callable, then
+        # atomictempfile no longer has either of rename (pre-1.9) or
+        # close (post-1.9)
+        getattr(file, 'rename', getattr(file, 'close', None))()
 
     ## END FILE LOAD AND SAVE METHODS
 
@@ -186,9 +417,9 @@ class GitHandler(object):
 
         return len(modheads)
 
-    def export_commits(self):
+    def export_commits(self, heads=None):
         try:
-            self.export_git_objects()
+            self.export_git_objects(heads)
             self.export_hg_tags()
             self.update_references()
         finally:
@@ -196,35 +427,58 @@ class GitHandler(object):
 
     def get_refs(self, remote):
         self.export_commits()
+        old_refs = self.ls_remote(remote)
+        to_push = set(self.local_heads().values() + self.pushtags().values())
+        new_refs = self.get_changed_refs(old_refs, to_push, True)
+
+        changed_refs = [ref for ref, sha in new_refs.iteritems()
+                        if sha != old_refs.get(ref)]
+        new = [bin(self.map_hg_get(new_refs[ref])) for ref in changed_refs]
+        old = {}
+        for r in old_refs:
+            old_ref = self.map_hg_get(old_refs[r])
+            if old_ref:
+                old[bin(old_ref)] = 1
+
+        return old, new
+
+    def ls_remote(self, remote):
+        """Return the refs advertised by remote.
+
+        Only the ref advertisement is read, through upload-pack, which
+        needs no push access; refs read recently are taken from the
+        git.lsremotettl cache instead.
+        """
+        refs = self.load_ls_remote(remote)
+        if refs is not None:
+            return refs
         client, path = self.get_transport_and_path(remote)
-        old_refs = {}
-        new_refs = {}
-        def changed(refs):
-            old_refs.update(refs)
-            to_push = set(self.local_heads().values() + self.tags.values())
-            new_refs.update(self.get_changed_refs(refs, to_push, True))
-            # don't push anything
-            return {}
-
         try:
-            client.send_pack(path, changed, None)
-
-            changed_refs = [ref for ref, sha in new_refs.iteritems()
-                            if sha != old_refs.get(ref)]
-            new = [bin(self.map_hg_get(new_refs[ref])) for ref in changed_refs]
-            old = {}
-            for r in old_refs:
-                old_ref = self.map_hg_get(old_refs[r])
-                if old_ref:
-                    old[bin(old_ref)] = 1
-
-            return old, new
+            refs = client.fetch_pack(path, lambda refs: [],
+                                     self.git.get_graph_walker(),
+                                     lambda data: None)
         except (HangupException, GitProtocolError), e:
             raise hgutil.Abort(_("git remote error: ") + str(e))
+        self.save_ls_remote(remote, refs)
+        return refs
 
     def push(self, remote, revs, force):
-        self.export_commits()
-        changed_refs = self.upload_pack(remote, revs, force)
+        # only export what can be pushed: the given revs, or else what
+        # upload_pack will push, bookmarks and tags (and tip, which gets
+        # bookmarked if there are no bookmarks)
+        heads = revs
+        if not heads:
+            heads = self.local_heads().values() + self.pushtags().values()
+            heads += [hex(node) for tag, node in self.repo.tags().iteritems()
+                      if self.repo.tagtype(tag) in ('global', 'git')]
+            if not self.local_heads():
+                heads.append('tip')
+        self.export_commits(heads)
+        try:
+            changed_refs = self.upload_pack(remote, revs, force)
+        finally:
+            # whatever got pushed, the remembered refs are out of date
+            self.save_ls_remote(remote, None)
         remote_name = self.remote_name(remote)
 
         if remote_name and changed_refs:
@@ -236,6 +490,16 @@ class GitHandler(object):
 
     def clear(self):
         mapfile = self.repo.join(self.mapfile)
+        if self.graph is not None:
+            self.graph.close()
+            self.graph = None
+        if self.treemap is not None:
+            self.treemap.close()
+            self.treemap = None
+        if self.blobmap is not None:
+            self.blobmap.close()
+            self.blobmap = None
+        self.objects = None
         if os.path.exists(self.gitdir):
             for root, dirs, files in os.walk(self.gitdir, topdown=False):
                 for name in files:
@@ -243,8 +507,13 @@ class GitHandler(object):
                 for name in dirs:
                     os.rmdir(os.path.join(root, name))
             os.rmdir(self.gitdir)
-        if os.path.exists(mapfile):
-            os.remove(mapfile)
+        self._map.close()
+        _handlers.pop(self.repo.path, None)
+        for path in (mapfile, self._map.journalpath,
+                     self.repo.join(self.exportedfile),
+                     self.repo.join(self.lsremotefile)):
+            if os.path.exists(path):
+                os.remove(path)
 
     # incoming support
     def getremotechanges(self, remote, revs):
@@ -261,7 +530,7 @@ class GitHandler(object):
         else:
             reqrefs = refs
 
-        commits = [bin(c) for c in self.getnewgitcommits(reqrefs)[1]]
+        commits = [bin(c) for c in self.getnewgitcommits(reqrefs)]
 
         b = overlayrepo(self, commits, refs)
 
@@ -269,25 +538,128 @@ class GitHandler(object):
 
     ## CHANGESET CONVERSION METHODS
 
-    def export_git_objects(self):
+    def export_git_objects(self, heads=None):
+        """Convert the changesets not yet in git into git objects.
+
+        If heads is given, only those changesets and their ancestors are
+        converted.
+        """
         self.init_if_missing()
 
-        nodes = [self.repo.lookup(n) for n in self.repo]
-        export = [node for node in nodes if not hex(node) in self._map_hg]
+        # only look at the changesets added since the last complete export
+        start = self.load_exported() + 1
+        tip = len(self.repo) - 1
+        revs = xrange(start, tip + 1)
+        if heads is not None:
+            needed = self.ancestorrevs(heads, start)
+            # unexported changesets left out keep the marker from moving
+            # past them
+            for r in revs:
+                if (r not in needed and
+                    not self.map_git_get(hex(self.repo.changelog.node(r)))):
+                    tip = r - 1
+                    break
+            revs = sorted(needed)
+        nodes = [self.repo.changelog.node(r) for r in revs]
+        export = [node for node in nodes if not self.map_git_get(hex(node))]
         total = len(export)
         if total:
             self.ui.status(_("exporting hg objects to git\n"))
-        for i, rev in enumerate(export):
-            util.progress(self.ui, 'exporting', i, total=total)
-            ctx = self.repo.changectx(rev)
-            state = ctx.extra().get('hg-git', None)
-            if state == 'octopus':
-                self.ui.debug("revision %d is a part "
-                              "of octopus explosion\n" % ctx.rev())
-                continue
-            self.export_hg_commit(rev)
+        self._exportthreads = self.ui.configint('git', 'exportthreads', 0)
+        if self._exportthreads <= 0:
+            self._exportthreads = _cpucount()
+        if self._exportthreads > 1 and total and ThreadPool is not None:
+            self._pool = ThreadPool(self._exportthreads)
+        if self.ui.configbool('git', 'exportpack', True):
+            self._packwriter = packwriter(
+                self.git.object_store, pool=self._pool,
+                unpacklimit=self.ui.configint('git', 'unpacklimit', 100))
+        try:
+            for i, rev in enumerate(export):
+                util.progress(self.ui, 'exporting', i, total=total)
+                ctx = self.repo.changectx(rev)
+                state = ctx.extra().get('hg-git', None)
+                if state == 'octopus':
+                    self.ui.debug("revision %d is a part "
+                                  "of octopus explosion\n" % ctx.rev())
+                    continue
+                self.export_hg_commit(rev)
+                # the map must never refer to objects that are not written
+                # yet, so while packing it is flushed along with the pack
+                if self._packwriter is not None:
+                    if self._packwriter.full():
+                        self.flush_pack()
+                        self.flush_maps()
+                elif (i + 1) % self.mapflush == 0:
+                    self.flush_maps()
+            if self._packwriter is not None:
+                self.flush_pack()
+        finally:
+            try:
+                if self._packwriter is not None and len(self._packwriter):
+                    # the export failed: forget the objects that were not
+                    # written, and the cache, graph and map entries naming
+                    # them
+                    self._packwriter.discard()
+                    for m in (self._map, self.treemap, self.blobmap,
+                              self.graph):
+                        if m is not None:
+                            m.load()
+                    self._subtrees = {}
+                self._packwriter = None
+            finally:
+                if self._pool is not None:
+                    self._pool.close()
+                    self._pool.join()
+                    self._pool = None
         util.progress(self.ui, 'importing', None, total=total)
 
+        if tip >= start:
+            # the marker must never get ahead of the map
+            self.flush_maps()
+            self.save_exported(tip)
+
+    def ancestorrevs(self, heads, start):
+        """Return the revs from start on that are ancestors of heads.
+
+        heads are changeset identifiers; a changeset counts as its own
+        ancestor.
+        """
+        cl = self.repo.changelog
+        needed = set(self.repo[h].rev() for h in heads)
+        needed = set(r for r in needed if r >= start)
+        if not needed:
+            return needed
+        for r in xrange(max(needed), start - 1, -1):
+            if r in needed:
+                for p in cl.parentrevs(r):
+                    if p >= start:
+                        needed.add(p)
+        return needed
+
+    def flush_pack(self):
+        """Write the objects queued by the export to a pack."""
+        self._packwriter.flush()
+        if self.objects.filter is not None:
+            self.objects.filter.refresh()
+
+    def add_export_object(self, obj, base=None):
+        """Write an exported git object.
+
+        While exporting to a pack, the object is queued there, as a delta
+        against base (the SHA of a related object) if that pays off.
+        """
+        if self._packwriter is not None:
+            self._packwriter.add_object(obj, base)
+        else:
+            self.git.object_store.add_object(obj)
+
+    def get_export_object(self, sha):
+        """Read a git object, including objects queued by the export."""
+        if self._packwriter is not None:
+            return self._packwriter[sha]
+        return self.objects[sha]
+
 
     # convert this commit into git objects
     # go through the manifest, convert all blobs/trees we don't have
@@ -340,11 +712,13 @@ class GitHandler(object):
         if 'encoding' in extra:
             commit.encoding = extra['encoding']
 
-        tree_sha = commit_tree(self.git.object_store, self.iterblobs(ctx))
-        commit.tree = tree_sha
+        commit.tree = self.export_tree(ctx)
 
-        self.git.object_store.add_object(commit)
+        self.add_export_object(commit)
         self.map_set(commit.id, ctx.hex())
+        self.update_commit_graph(commit.parents)
+        self.graph.add(commit.id, commit.parents, int(commit.commit_time),
+                       commit.commit_timezone)
 
         self.swap_out_encoding(oldenc)
         return commit.id
@@ -434,33 +808,180 @@ class GitHandler(object):
 
         return message
 
-    def iterblobs(self, ctx):
-        for f in ctx:
-            fctx = ctx[f]
-            blobid = self.map_git_get(hex(fctx.filenode()))
+    def export_tree(self, ctx):
+        """Write the git tree for the manifest of ctx and return its SHA.
+
+        When the tree of the first parent's manifest was built by us, only
+        the files that differ from it are applied, rewriting just the
+        directories along their paths. Otherwise the tree is built from
+        the whole manifest.
+        """
+        mnode = hex(ctx.changeset()[0])
+        tree = self.treemap.git(mnode)
+        if tree is not None:
+            return tree
+
+        parents = ctx.parents()
+        pmnode = hex(parents[0].changeset()[0])
+        ptree = self.treemap.git(pmnode)
+        if pmnode != hex(nullid) and ptree is None:
+            store = self._packwriter
+            if store is None:
+                store = self.git.object_store
+            tree = commit_tree(store, self.iterblobs(ctx))
+        else:
+            if len(parents) > 1:
+                # the files of a merge are not relative to either parent
+                files = self.manifest_changes(parents[0].manifest(),
+                                              ctx.manifest())
+            else:
+                files = ctx.files()
+            manifest = ctx.manifest()
+            changes = dict((f, None) for f in files if f not in manifest)
+            for f, blobid, mode in self.iterblobs(
+                ctx, [f for f in files if f in manifest]):
+                changes[f] = (mode, blobid)
+            tree = self.update_tree(ptree, changes)
+            if tree is None:
+                tree = Tree()
+                self.add_export_object(tree)
+                tree = tree.id
+
+        self.treemap.set(tree, mnode)
+        return tree
+
+    def manifest_changes(self, mf1, mf2):
+        """Return the files whose node or flags differ between manifests."""
+        files = [f for f in mf1 if f not in mf2]
+        for f, n in mf2.iteritems():
+            if mf1.get(f) != n or mf1.flags(f) != mf2.flags(f):
+                files.append(f)
+        return files
 
-            if not blobid:
-                blob = Blob.from_string(fctx.data())
-                self.git.object_store.add_object(blob)
-                self.map_set(blob.id, hex(fctx.filenode()))
-                blobid = blob.id
-
-            if 'l' in ctx.flags(f):
-                mode = 0120000
-            elif 'x' in ctx.flags(f):
-                mode = 0100755
+    def update_tree(self, treesha, changes):
+        """Apply changes to a tree and write the trees that changed.
+
+        changes maps paths relative to the tree to (mode, sha) entries, or
+        to None for paths to remove; treesha may be None for an empty
+        tree. Returns the new tree SHA, or None if the tree became empty.
+        """
+        tree = Tree()
+        if treesha is not None:
+            old = self._subtrees.get(treesha)
+            if old is None:
+                old = self.get_export_object(treesha)
+            for name, mode, sha in old.iteritems():
+                tree[name] = (mode, sha)
+
+        subdirs = {}
+        added = []
+        for path, entry in changes.iteritems():
+            if '/' in path:
+                d, rest = path.split('/', 1)
+                subdirs.setdefault(d, {})[rest] = entry
+            elif entry is None:
+                if path in tree:
+                    del tree[path]
+            else:
+                added.append((path, entry))
+
+        # removals first and additions last, so that a file replacing a
+        # directory (or the other way round) ends up in the tree
+        for d, subchanges in subdirs.iteritems():
+            subsha = None
+            if d in tree:
+                mode, sha = tree[d]
+                if stat.S_ISDIR(mode):
+                    subsha = sha
+            subsha = self.update_tree(subsha, subchanges)
+            if subsha is None:
+                if d in tree:
+                    del tree[d]
             else:
-                mode = 0100644
+                tree[d] = (stat.S_IFDIR, subsha)
+        for path, entry in added:
+            tree[path] = entry
+
+        if not len(tree):
+            return None
+        if tree.id != treesha and tree.id not in self._subtrees:
+            self.add_export_object(tree, base=treesha)
+            # the next changeset most likely changes the same directories
+            if len(self._subtrees) >= 10000:
+                self._subtrees.clear()
+            self._subtrees[tree.id] = tree
+        return tree.id
+
+    def iterblobs(self, ctx, files=None):
+        """Yield (path, blob SHA, git mode) for files of ctx, in order.
+
+        files defaults to the whole manifest. Blobs we do not have yet are
+        written. File data is read here, but hashing the new blobs is left
+        to the export worker pool, which is kept busy with the blobs of
+        the next few files while earlier ones are handed out.
+        """
+        if files is None:
+            files = ctx
+        window = collections.deque()
+        ahead = 4 * self._exportthreads
+        for f in files:
+            fctx = ctx[f]
+            blobid = self.blob_get(hex(fctx.filenode()))
+            blob = None
+            if not blobid:
+                if self._pool is not None:
+                    blob = self._pool.apply_async(_makeblob, (fctx.data(),))
+                else:
+                    blob = _makeblob(fctx.data())
+            window.append((f, fctx, blobid, blob))
+            if len(window) > ahead:
+                yield self._finishblob(ctx, *window.popleft())
+        while window:
+            yield self._finishblob(ctx, *window.popleft())
+
+    def _finishblob(self, ctx, f, fctx, blobid, blob):
+        if not blobid:
+            if self._pool is not None:
+                blob = blob.get()
+            # identical content may already be stored for another file
+            known = blob.id in self.objects
+            if not known and self._packwriter is not None:
+                known = self._packwriter.ispending(blob.id)
+            if not known:
+                # the previous revision of the file makes a good delta base
+                base = fctx.filelog().parents(fctx.filenode())[0]
+                if base != nullid:
+                    base = self.blob_get(hex(base))
+                else:
+                    base = None
+                self.add_export_object(blob, base)
+            self.blobmap.set(blob.id, hex(fctx.filenode()))
+            blobid = blob.id
+
+        if 'l' in ctx.flags(f):
+            mode = 0120000
+        elif 'x' in ctx.flags(f):
+            mode = 0100755
+        else:
+            mode = 0100644
 
-            yield f, blobid, mode
+        return f, blobid, mode
 
     def getnewgitcommits(self, refs=None):
+        return list(self.iternewgitcommits(refs))
+
+    def iternewgitcommits(self, refs=None):
+        """Yield the SHAs of the commits that still need converting.
+
+        Commits are yielded oldest first, parents always before their
+        children. Only SHAs are held while walking; commit objects are
+        left for the caller to read when it needs them.
+        """
         self.init_if_missing()
 
         # import heads and fetched tags as remote references
         todo = []
         done = set()
-        convert_list = {}
 
         # get a list of all the head shas
         seenheads = set()
@@ -470,57 +991,152 @@ class GitHandler(object):
             for sha in refs.itervalues():
                 # refs contains all the refs in the server, not just the ones
                 # we are pulling
-                if sha in self.git.object_store:
-                    obj = self.git.get_object(sha)
+                if sha in self.objects:
+                    obj = self.objects[sha]
                     while isinstance(obj, Tag):
                         obj_type, sha = obj.object
-                        obj = self.git.get_object(sha)
+                        obj = self.objects[sha]
                     if isinstance (obj, Commit) and sha not in seenheads:
                         seenheads.add(sha)
                         todo.append(sha)
 
+        self.update_commit_graph(todo)
+
         # sort by commit date
         def commitdate(sha):
-            obj = self.git.get_object(sha)
-            return obj.commit_time-obj.commit_timezone
+            time, timezone = self.graph.committime(sha)
+            return time - timezone
 
         todo.sort(key=commitdate, reverse=True)
 
-        # traverse the heads getting a list of all the unique commits
-        commits = []
-        seen = set(todo)
+        # traverse the heads, yielding each unique commit that still needs
+        # converting once all its parents have been yielded; commits already
+        # in the map are treated as done, so the walk stops at the boundary
+        # of what we have imported. Each stack entry is a SHA and the index
+        # of the next parent to visit.
+        todo = [(sha, 0) for sha in todo]
         while todo:
-            sha = todo[-1]
+            sha, nextparent = todo[-1]
             if sha in done:
                 todo.pop()
                 continue
             assert isinstance(sha, str)
-            obj = self.git.get_object(sha)
-            assert isinstance(obj, Commit)
-            for p in obj.parents:
-                if p not in done:
-                    todo.append(p)
-                    break
+            if not nextparent and self.map_hg_get(sha):
+                done.add(sha)
+                todo.pop()
+                continue
+            parents = self.graph.parents(sha)
+            while nextparent < len(parents) and parents[nextparent] in done:
+                nextparent += 1
+            if nextparent < len(parents):
+                todo[-1] = (sha, nextparent + 1)
+                todo.append((parents[nextparent], 0))
             else:
-                commits.append(sha)
-                convert_list[sha] = obj
                 done.add(sha)
                 todo.pop()
+                yield sha
+
+    def update_commit_graph(self, heads):
+        """Add the commits reachable from heads to the commit graph.
+
+        Only commits the graph does not know yet are read; the walk stops
+        wherever it reaches known history.
+        """
+        graph = self.graph
+        store = self.objects
+        todo = [(sha, None) for sha in heads if sha not in graph]
+        while todo:
+            sha, commit = todo[-1]
+            if sha in graph:
+                todo.pop()
+                continue
+            if commit is None:
+                obj = self.objects[sha]
+                commit = (obj.parents, obj.commit_time, obj.commit_timezone)
+                todo[-1] = (sha, commit)
+            parents, time, timezone = commit
+            missing = [p for p in parents if p not in graph and p in store]
+            if missing:
+                todo.extend([(p, None) for p in missing])
+            else:
+                graph.add(sha, parents, time, timezone)
+                todo.pop()
 
-        return convert_list, [commit for commit in commits if not commit in self._map_git]
+    def is_ancestor(self, ancestor, descendant):
+        """Tell whether hg changeset ancestor is an ancestor of descendant.
+
+        The commit graph answers when it knows both commits and enough of
+        their history; otherwise the changelog is asked.
+        """
+        graph = self.graph
+        a = self.map_git_get(ancestor)
+        d = self.map_git_get(descendant)
+        if graph is not None and a and d and a in graph and d in graph:
+            result = graph.isancestor(a, d)
+            if result is not None:
+                return result
+        actx = self.repo[ancestor]
+        return actx.ancestor(self.repo[descendant]) == actx
 
     def import_git_objects(self, remote_name=None, refs=None):
-        convert_list, commits = self.getnewgitcommits(refs)
-        # import each of the commits, oldest first
-        total = len(commits)
+        # the walk only touches the commit graph, so counting the commits
+        # first for the progress bar is cheap
+        total = sum(1 for csha in self.iternewgitcommits(refs))
         if total:
             self.ui.status(_("importing git objects into hg\n"))
 
-        for i, csha in enumerate(commits):
-            util.progress(self.ui, 'importing', i, total=total, unit='commits')
-            commit = convert_list[csha]
-            self.import_git_commit(commit)
+        # import each of the commits, oldest first, reading each commit
+        # object only when its turn comes. Commits are grouped into one
+        # transaction per importbatch commits; the map is flushed right
+        # after each transaction closes, so it never refers to changesets
+        # that could still be rolled back.
+        batch = self.ui.configint('git', 'importbatch', 1000)
+        # a worker reads the next few commits and their new file contents
+        # while the current one is written to the revlogs
+        ahead = self.ui.configint('git', 'importahead', 8)
+        pool = None
+        if ahead > 0 and total > 1 and ThreadPool is not None:
+            pool = ThreadPool(1)
+        lock = self.repo.lock()
+        tr = None
+        # if everything was exported, the imported changesets keep it so
+        exported = self.load_exported() == len(self.repo) - 1
+        # anything set before the import is kept if a batch aborts
+        self._map.flush()
+        try:
+            commits = self.iterimportcommits(self.iternewgitcommits(refs),
+                                             pool, ahead)
+            for i, (commit, files, blobs) in enumerate(commits):
+                util.progress(self.ui, 'importing', i, total=total,
+                              unit='commits')
+                if tr is None:
+                    tr = self.repo.transaction('gimport')
+                self.import_git_commit(commit, files, blobs)
+                if (i + 1) % batch == 0:
+                    tr.close()
+                    tr = None
+                    self._map.flush()
+            if tr is not None:
+                tr.close()
+                tr = None
+                self._map.flush()
+            if exported and total:
+                self.save_exported(len(self.repo) - 1)
+        finally:
+            if tr is not None:
+                # hg before 1.7 has no release(); dropping the last
+                # reference aborts the transaction there
+                getattr(tr, 'release', lambda: None)()
+                tr = None
+                # forget the pairs of the aborted batch along with its
+                # changesets, which the repo may still have cached
+                self._map.load()
+                self.repo.invalidate()
+            if pool is not None:
+                pool.terminate()
+            lock.release()
         util.progress(self.ui, 'importing', None, total=total, unit='commits')
+        self.ui.debug(_("object cache: %s\n") % self.objects.stats())
 
         # Remove any dangling tag references.
         for name, rev in self.repo.tags().items():
@@ -536,14 +1152,46 @@ class GitHandler(object):
                 if name in self.repo._tagtypes:
                     del self.repo._tagtypes[name]
 
-    def import_git_commit(self, commit):
+    def iterimportcommits(self, shas, pool=None, ahead=0):
+        """Yield (commit, changed files, blob contents) for each SHA.
+
+        The blob contents map the SHA of every new or modified file to its
+        data. Given a pool, its single worker reads up to ahead commits
+        past the one last yielded; it then does all the reading from the
+        object store, which must not be used elsewhere until this is done.
+        """
+        if pool is None:
+            for sha in shas:
+                yield self._readimportcommit(sha)
+            return
+        window = collections.deque()
+        for sha in shas:
+            window.append(pool.apply_async(self._readimportcommit, (sha,)))
+            if len(window) > ahead:
+                yield window.popleft().get()
+        while window:
+            yield window.popleft().get()
+
+    def _readimportcommit(self, sha):
+        commit = self.objects[sha]
+        files = self.get_files_changed(commit)
+        blobs = {}
+        for delete, mode, blobsha in files.itervalues():
+            if not delete:
+                blobs[blobsha] = self.objects[blobsha].data
+        return commit, files, blobs
+
+    def import_git_commit(self, commit, files=None, blobs=None):
         self.ui.debug(_("importing: %s\n") % commit.id)
 
         (strip_message, hg_renames,
          hg_branch, extra) = self.extract_hg_metadata(commit.message)
 
         # get a list of the changed, added, removed files
-        files = self.get_files_changed(commit)
+        if files is None:
+            files = self.get_files_changed(commit)
+        if blobs is None:
+            blobs = {}
 
         date = (commit.author_time, -commit.author_timezone)
         text = strip_message
@@ -592,10 +1240,29 @@ class GitHandler(object):
             # begin with).
             if p2 == nullid:
                 return []
-            manifest1 = self.repo.changectx(p1).manifest()
-            manifest2 = self.repo.changectx(p2).manifest()
-            return [path for path, node1 in manifest1.iteritems()
-                    if path not in files and manifest2.get(path, node1) != node1]
+            # A file can only be at different revisions in the two parents
+            # if it was touched on one side since they forked, so look up
+            # the paths in the changed-file lists of those changesets
+            # instead of walking every entry of both manifests.
+            cl = self.repo.changelog
+            ctx1 = self.repo.changectx(p1)
+            ctx2 = self.repo.changectx(p2)
+            touched = set()
+            for a, b in ((ctx1, ctx2), (ctx2, ctx1)):
+                for node in cl.findmissing([b.node()], [a.node()]):
+                    touched.update(cl.read(node)[3])
+            converged = []
+            for path in sorted(touched):
+                if path in files:
+                    continue
+                try:
+                    node1 = ctx1.filenode(path)
+                    node2 = ctx2.filenode(path)
+                except error.LookupError:
+                    continue
+                if node1 != node2:
+                    converged.append(path)
+            return converged
 
         def getfilectx(repo, memctx, f):
             info = files.get(f)
@@ -605,7 +1272,10 @@ class GitHandler(object):
                 if delete:
                     raise IOError
 
-                data = self.git[sha].data
+                if sha in blobs:
+                    data = blobs[sha]
+                else:
+                    data = self.objects[sha].data
                 copied_path = hg_renames.get(f)
                 e = self.convert_git_int_mode(mode)
             else:
@@ -690,27 +1360,184 @@ class GitHandler(object):
     ## PACK UPLOADING AND FETCHING
 
     def upload_pack(self, remote, revs, force):
-        client, path = self.get_transport_and_path(remote)
+        transport, path = self.get_transport_and_path(remote)
         def changed(refs):
-            to_push = revs or set(self.local_heads().values() + self.tags.values())
+            to_push = revs or set(self.local_heads().values() + self.pushtags().values())
             return self.get_changed_refs(refs, to_push, force)
 
-        genpack = self.git.object_store.generate_pack_contents
+        remote_name = self.remote_name(remote)
+        # objects the remote already has can serve as delta bases in a
+        # thin pack
+        known = set()
+        if not self.ui.configbool('git', 'thinpacks', True):
+            known = None
+        def genpack(have, want):
+            return self.generate_pack_contents(have, want, remote_name, known)
+        reused = set()
+        def writeobjects(f, objects):
+            return writepack(f, objects, self.git.object_store, known or (),
+                             reused)
+        # newer dulwich lets us write the pack, keeping the deltas our
+        # packs already store instead of computing them again
+        kwargs = {}
+        if 'write_pack' in inspect.getargspec(transport.send_pack)[0]:
+            kwargs['write_pack'] = writeobjects
         try:
             self.ui.status(_("creating and sending data\n"))
-            changed_refs = client.send_pack(path, changed, genpack)
+            changed_refs = transport.send_pack(path, changed, genpack,
+                                               **kwargs)
+            self.ui.debug(_("reused %d stored deltas\n") % len(reused))
             return changed_refs
         except (HangupException, GitProtocolError), e:
             raise hgutil.Abort(_("git remote error: ") + str(e))
 
+    def generate_pack_contents(self, have, want, remote_name=None,
+                               known=None):
+        """Return the (object, path) pairs a remote needs to get want.
+
+        The remote has the commits in have, which it advertised, and any
+        of our refs/remotes/remote_name refs; it therefore has everything
+        reachable from them. Only commits it lacks are sent, and of their
+        trees only what differs from the trees of their parents. If known
+        is given, the SHAs of the parents' trees and files that were
+        compared against, which the remote has or is sent, are added to it.
+        """
+        if known is None:
+            known = set()
+        objects = self.objects
+        haves = set(sha for sha in have if sha in objects)
+        if remote_name:
+            prefix = 'refs/remotes/%s/' % remote_name
+            haves.update(sha for sha in
+                         self.git.refs.as_dict(prefix).itervalues()
+                         if sha in objects)
+
+        result = []
+        sent = set(haves)
+        def peel(shas, send):
+            # find the commits behind annotated tags, sending the tags
+            # themselves along if asked to
+            commits = set()
+            for sha in shas:
+                obj = objects[sha]
+                while isinstance(obj, Tag):
+                    if send and sha not in sent:
+                        sent.add(sha)
+                        result.append((obj, None))
+                    sha = obj.object[1]
+                    obj = objects[sha]
+                if isinstance(obj, Commit):
+                    commits.add(sha)
+            return commits
+        missing = self.find_missing_commits(peel(haves, False),
+                                            peel(set(want) - haves, True))
+
+        for sha in missing:
+            commit = objects[sha]
+            sent.add(sha)
+            result.append((commit, None))
+            bases = [objects[p].tree for p in commit.parents]
+            known.update(bases)
+            self._addtreecontents(commit.tree, bases, '', sent, result,
+                                  known)
+        self.ui.debug(_("%d objects to send for %d commits\n")
+                      % (len(result), len(missing)))
+        return result
+
+    def find_missing_commits(self, haves, wants):
+        """Return the commits reachable from wants but not from haves.
+
+        Like git, the walk goes newest commit first and stops as soon as
+        everything left to visit is reachable from haves.
+        """
+        objects = self.objects
+        parents = {}
+        seen = set()
+        boring = set()
+        heap = []
+        # the commits in heap, and how many of them are not boring
+        queued = set()
+        interesting = [0]
+        def markboring(sha):
+            stack = [sha]
+            while stack:
+                sha = stack.pop()
+                if sha not in boring:
+                    boring.add(sha)
+                    if sha in queued:
+                        interesting[0] -= 1
+                    stack.extend(parents.get(sha, ()))
+        def queue(sha, isboring):
+            if isboring:
+                markboring(sha)
+            if sha not in seen and sha in objects:
+                seen.add(sha)
+                queued.add(sha)
+                if sha not in boring:
+                    interesting[0] += 1
+                heapq.heappush(heap, (-objects[sha].commit_time, sha))
+        for sha in haves:
+            queue(sha, True)
+        for sha in wants:
+            queue(sha, False)
+        while interesting[0]:
+            time, sha = heapq.heappop(heap)
+            queued.remove(sha)
+            if sha not in boring:
+                interesting[0] -= 1
+            parents[sha] = objects[sha].parents
+            for p in parents[sha]:
+                queue(p, sha in boring)
+        return [sha for sha in parents if sha not in boring]
+
+    def _addtreecontents(self, treesha, bases, path, sent, result, known):
+        """Add the tree and what it holds that is in none of bases.
+
+        bases are the SHAs of the trees at the same path in the parent
+        commits; a subtree found in one of them is skipped whole. What the
+        tree is compared against is added to known.
+        """
+        if treesha in sent or treesha in bases:
+            return
+        sent.add(treesha)
+        tree = self.objects[treesha]
+        result.append((tree, path))
+        basetrees = [self.objects[b] for b in bases]
+        for name, mode, sha in tree.iteritems():
+            if mode == 0160000:
+                # submodule commits are not ours to send
+                continue
+            entrybases = []
+            for basetree in basetrees:
+                try:
+                    basemode, basesha = basetree[name]
+                except KeyError:
+                    continue
+                if stat.S_ISDIR(basemode) == stat.S_ISDIR(mode):
+                    entrybases.append(basesha)
+            known.update(entrybases)
+            entrypath = path and path + '/' + name or name
+            if stat.S_ISDIR(mode):
+                self._addtreecontents(sha, entrybases, entrypath, sent,
+                                      result, known)
+            elif sha not in sent and sha not in entrybases:
+                sent.add(sha)
+                result.append((self.objects[sha], entrypath))
+
     def get_changed_refs(self, refs, revs, force):
         new_refs = refs.copy()
 
         #The remote repo is empty and the local one doesn't have bookmarks/tags
-        if refs.keys()[0] == 'capabilities^{}':
-            del new_refs['capabilities^{}']
+        if not refs or refs.keys()[0] == 'capabilities^{}':
+            new_refs.pop('capabilities^{}', None)
             if not self.local_heads():
-                tip = hex(self.repo.lookup('tip'))
+                # push only exported the given revisions, so bookmark the
+                # last of them rather than tip
+                if revs:
+                    tip = hex(self.repo.changelog.node(
+                        max([self.repo[r].rev() for r in revs])))
+                else:
+                    tip = hex(self.repo.lookup('tip'))
                 try:
                     commands.bookmark(self.ui, self.repo, 'master', tip, force=True)
                 except NameError:
@@ -727,7 +1554,8 @@ class GitHandler(object):
             prep = lambda itr: [i.replace(' ', '_') for i in itr]
 
             heads = [t for t in prep(labels(ctx)) if t in self.local_heads()]
-            tags = [t for t in prep(labels(ctx)) if t in self.tags]
+            pushtags = self.pushtags()
+            tags = [t for t in prep(labels(ctx)) if t in pushtags]
 
             if not (heads or tags):
                 raise hgutil.Abort("revision %s cannot be pushed since"
@@ -748,7 +1576,7 @@ class GitHandler(object):
                     continue
                 try:
                     # We're not using Repo.tag(), as it's deprecated.
-                    tag = self.git.get_object(refs[ref])
+                    tag = self.objects[refs[ref]]
                     if not isinstance(tag, Tag):
                         continue
                 except KeyError:
@@ -765,9 +1593,9 @@ class GitHandler(object):
 
                 if ref not in refs:
                     new_refs[ref] = self.map_git_get(ctx.hex())
-                elif new_refs[ref] in self._map_git:
+                elif self.map_hg_get(new_refs[ref]):
                     rctx = self.repo[self.map_hg_get(new_refs[ref])]
-                    if rctx.ancestor(ctx) == rctx or force:
+                    if force or self.is_ancestor(rctx.hex(), ctx.hex()):
                         new_refs[ref] = self.map_git_get(ctx.hex())
                     else:
                         raise hgutil.Abort("pushing %s overwrites %s"
@@ -805,20 +1633,53 @@ class GitHandler(object):
                 want = [sha for ref, sha in refs.iteritems()
                         if not ref.endswith('^{}')
                         and ( ref.startswith('refs/heads/') or ref.startswith('refs/tags/') ) ]
-            want = [x for x in want if x not in self.git]
+            want = [x for x in want if x not in self.objects]
             return want
-        f, commit = self.git.object_store.add_pack()
+        # nothing to fetch if what the remote recently advertised is here
+        refs = self.load_ls_remote(remote_name)
+        if refs is not None and not determine_wants(refs):
+            return refs
+        f, commit = self.add_fetched_pack()
         try:
             try:
                 progress = GitProgress(self.ui)
                 ret = client.fetch_pack(path, determine_wants, graphwalker,
                                         f.write, progress.progress)
                 progress.flush()
+                self.save_ls_remote(remote_name, ret)
                 return ret
             except (HangupException, GitProtocolError), e:
                 raise hgutil.Abort(_("git remote error: ") + str(e))
         finally:
             commit()
+            if self.objects.filter is not None:
+                self.objects.filter.refresh()
+
+    def add_fetched_pack(self):
+        """Return a file to receive a fetched pack into and a function to
+        move the pack into the object store once it has been written.
+
+        A thin pack may hold deltas against objects that we already have
+        rather than sending them again; the store completes it with those
+        bases before it is indexed.
+        """
+        store = self.git.object_store
+        if not self.ui.configbool('git', 'thinpacks', True):
+            result = store.add_pack()
+            return result[0], result[1]
+        if not inspect.getargspec(store.add_thin_pack)[0][1:]:
+            result = store.add_thin_pack()
+            return result[0], result[1]
+        # newer dulwich reads the thin pack itself, so spool it first
+        f = tempfile.TemporaryFile(dir=store.pack_dir)
+        def commit():
+            try:
+                if f.tell():
+                    f.seek(0)
+                    store.add_thin_pack(f.read, None)
+            finally:
+                f.close()
+        return f, commit
 
     ## REFERENCES HANDLING
 
@@ -833,11 +1694,26 @@ class GitHandler(object):
                 self.git.refs['refs/heads/' + key] = self.map_git_get(heads[key])
 
     def export_hg_tags(self):
+        self.exportedtags = {}
         for tag, sha in self.repo.tags().iteritems():
             if self.repo.tagtype(tag) in ('global', 'git'):
+                git_sha = self.map_git_get(hex(sha))
+                if not git_sha:
+                    # not exported yet, see export_git_objects
+                    continue
                 tag = tag.replace(' ', '_')
-                self.git.refs['refs/tags/' + tag] = self.map_git_get(hex(sha))
-                self.tags[tag] = hex(sha)
+                self.git.refs['refs/tags/' + tag] = git_sha
+                self.exportedtags[tag] = hex(sha)
+
+    def pushtags(self):
+        """Return the tags to push: those from git and the exported hg tags.
+
+        Exported tags are kept apart from self.tags, which is saved to the
+        tags file and shown as git tags.
+        """
+        tags = dict(self.tags)
+        tags.update(self.exportedtags)
+        return tags
 
     def local_heads(self):
         try:
@@ -860,19 +1736,19 @@ class GitHandler(object):
                 ref_name = "/".join([v for v in parts[2:]])
                 # refs contains all the refs in the server, not just
                 # the ones we are pulling
-                if refs[k] not in self.git.object_store:
+                if refs[k] not in self.objects:
                     continue
                 if ref_name[-3:] == '^{}':
                     ref_name = ref_name[:-3]
                 if not ref_name in self.repo.tags():
-                    obj = self.git.get_object(refs[k])
+                    obj = self.objects[refs[k]]
                     sha = None
                     if isinstance (obj, Commit): # lightweight
                         sha = self.map_hg_get(refs[k])
                         self.tags[ref_name] = sha
                     elif isinstance (obj, Tag): # annotated
                         (obj_type, obj_sha) = obj.object
-                        obj = self.git.get_object(obj_sha)
+                        obj = self.objects[obj_sha]
                         if isinstance (obj, Commit):
                             sha = self.map_hg_get(obj_sha)
                             # TODO: better handling for annotated tags
@@ -892,15 +1768,14 @@ class GitHandler(object):
             for head, sha in heads.iteritems():
                 # refs contains all the refs in the server, not just
                 # the ones we are pulling
-                if sha not in self.git.object_store:
+                if sha not in self.objects:
                     continue
                 hgsha = bin(self.map_hg_get(sha))
                 if not head in bms:
                     # new branch
                     bms[head] = hgsha
                 else:
-                    bm = self.repo[bms[head]]
-                    if bm.ancestor(self.repo[hgsha]) == bm:
+                    if self.is_ancestor(hex(bms[head]), hex(hgsha)):
                         # fast forward
                         bms[head] = hgsha
             if heads:
@@ -915,23 +1790,21 @@ class GitHandler(object):
                          ' bookmarks enabled?\n'))
 
     def update_remote_branches(self, remote_name, refs):
-        tagfile = self.repo.join(os.path.join('git-remote-refs'))
-        tags = self.repo.gitrefs()
+        tags = self.remote_refs
         # since we re-write all refs for this remote each time, prune
         # all entries matching this remote from our tags list now so
         # that we avoid any stale refs hanging around forever
         for t in list(tags):
             if t.startswith(remote_name + '/'):
                 del tags[t]
-        tags = dict((k, hex(v)) for k, v in tags.iteritems())
-        store = self.git.object_store
+        store = self.objects
         for ref_name, sha in refs.iteritems():
             if ref_name.startswith('refs/heads'):
                 if sha not in store:
                     continue
                 hgsha = self.map_hg_get(sha)
                 head = ref_name[11:]
-                tags['/'.join((remote_name, head))] = hgsha
+                tags['/'.join((remote_name, head))] = bin(hgsha)
                 # TODO(durin42): what is this doing?
                 new_ref = 'refs/remotes/%s/%s' % (remote_name, head)
                 self.git.refs[new_ref] = sha
@@ -939,10 +1812,7 @@ class GitHandler(object):
                   and not ref_name.endswith('^{}')):
                 self.git.refs[ref_name] = sha
 
-        tf = open(tagfile, 'wb')
-        for tag, node in tags.iteritems():
-            tf.write('%s %s\n' % (node, tag))
-        tf.close()
+        self.save_remote_refs()
 
 
     ## UTILITY FUNCTIONS
@@ -982,11 +1852,11 @@ class GitHandler(object):
         return (message, renames, branch, extra)
 
     def get_file(self, commit, f):
-        otree = self.git.tree(commit.tree)
+        otree = self.objects[commit.tree]
         parts = f.split('/')
         for part in parts:
             (mode, sha) = otree[part]
-            obj = self.git.get_object(sha)
+            obj = self.objects[sha]
             if isinstance (obj, Blob):
                 return (mode, sha, obj._text)
             elif isinstance(obj, Tree):
@@ -997,11 +1867,12 @@ class GitHandler(object):
         btree = None
 
         if commit.parents:
-            btree = self.git[commit.parents[0]].tree
+            btree = self.objects[commit.parents[0]].tree
 
-        changes = self.git.object_store.tree_changes(btree, tree)
         files = {}
-        for (oldfile, newfile), (oldmode, newmode), (oldsha, newsha) in changes:
+        for change in tree_changes(self.objects, btree, tree):
+            oldfile, oldmode, oldsha = change.old
+            newfile, newmode, newsha = change.new
             # don't create new submodules
             if newmode == 0160000:
                 if oldfile:
@@ -1058,6 +1929,8 @@ class GitHandler(object):
             return string.decode('ascii', 'replace').encode('utf-8')
 
     def get_transport_and_path(self, uri):
+        thin = self.ui.configbool('git', 'thinpacks', True)
+
         # pass hg's ui.ssh config to dulwich
         if not issubclass(client.get_ssh_vendor, _ssh.SSHVendor):
             client.get_ssh_vendor = _ssh.generate_ssh_vendor(self.ui)
@@ -1093,7 +1966,7 @@ class GitHandler(object):
                     else:
                         transportpath = path
 
-                return transport(host, thin_packs=False, port=port), transportpath
+                return transport(host, thin_packs=thin, port=port), transportpath
 
         httpclient = getattr(client, 'HttpGitClient', None)
 
@@ -1104,7 +1977,7 @@ class GitHandler(object):
             if not httpclient:
                 raise RepoError('git via HTTP requires dulwich 0.8.1 or later')
             else:
-                return client.HttpGitClient(uri, thin_packs=False), uri
+                return client.HttpGitClient(uri, thin_packs=thin), uri
 
         # if its not git or git+ssh, try a local url..
-        return client.SubprocessGitClient(thin_packs=False), uri
+        return client.SubprocessGitClient(thin_packs=thin), uri
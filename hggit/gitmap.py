@@ -0,0 +1,313 @@
+# binary storage for the git <-> hg SHA mapping
+#
+# The map file holds every (git, hg) pair twice, as fixed-width records of
+# two binary SHAs: once sorted by git SHA and once sorted by hg SHA. The
+# file is memory-mapped and both directions are looked up by bisecting the
+# relevant half, so loading the map costs nothing up front no matter how
+# many entries it has.
+#
+# Layout:
+#   magic (8 bytes) | gitcount (4 bytes) | hgcount (4 bytes), big endian
+#   gitcount records of git SHA (20 bytes) + hg SHA (20 bytes), sorted by git
+#   hgcount records of hg SHA (20 bytes) + git SHA (20 bytes), sorted by hg
+#
+# The two counts only differ if several git SHAs were mapped to the same hg
+# SHA or the other way round.
+#
+# New pairs are appended to a journal file next to the map, as unsorted
+# records of git SHA + hg SHA. Readers replay the journal on top of the
+# sorted map, and once it grows large enough it is compacted into the map.
+
+import binascii
+import bisect
+import mmap
+import os
+import struct
+
+from mercurial import util as hgutil
+
+MAGIC = 'HGGITMAP'
+_HEADER = struct.Struct('>8sLL')
+_RECORD = 40
+
+class _section(object):
+    """Sequence view over the keys of one sorted half of a map file."""
+    def __init__(self, data, offset, count):
+        self.data = data
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        pos = self.offset + i * _RECORD
+        return self.data[pos:pos + 20]
+
+    def value(self, i):
+        pos = self.offset + i * _RECORD + 20
+        return self.data[pos:pos + 20]
+
+    def get(self, key):
+        i = bisect.bisect_left(self, key)
+        if i < self.count and self[i] == key:
+            return self.value(i)
+        return None
+
+    def __iter__(self):
+        data = self.data
+        pos = self.offset
+        end = pos + self.count * _RECORD
+        while pos < end:
+            yield data[pos:pos + 20], data[pos + 20:pos + _RECORD]
+            pos += _RECORD
+
+def _merge(base, new):
+    """Merge sorted (key, value) pairs with a dict, the dict winning."""
+    pending = sorted(new.iteritems())
+    i = 0
+    for key, value in base:
+        while i < len(pending) and pending[i][0] < key:
+            yield pending[i]
+            i += 1
+        if i < len(pending) and pending[i][0] == key:
+            continue
+        yield key, value
+    while i < len(pending):
+        yield pending[i]
+        i += 1
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+class gitmap(object):
+    """Mapping between git and hg SHAs, backed by a sorted binary file.
+
+    SHAs are passed in and returned as 40-character hex strings. Pairs
+    added with set() are appended to the journal by flush(), and merged
+    into the sorted map by compact() once the journal holds at least
+    compactsize pairs (or a quarter of the map, if that is more). A map
+    file in the old text format ("gitsha hgsha" lines) is converted the
+    first time it is opened.
+    """
+    def __init__(self, path, compactsize=10000):
+        self.path = path
+        self.journalpath = path + '.journal'
+        self.compactsize = compactsize
+        self._file = None
+        self._data = ''
+        self._bygit = _section('', 0, 0)
+        self._byhg = _section('', 0, 0)
+        self._newgit = {}
+        self._newhg = {}
+        self._newsorted = None
+        self._journalsize = 0
+        self._unflushed = []
+        self._stamp = None
+        self.load()
+
+    def load(self):
+        self.close()
+        self._newgit = {}
+        self._newhg = {}
+        self._newsorted = None
+        self._journalsize = 0
+        self._unflushed = []
+        self._stamp = _stat(self.path)
+        if os.path.exists(self.path):
+            f = open(self.path, 'rb')
+            magic = f.read(len(MAGIC))
+            if magic and magic != MAGIC:
+                f.seek(0)
+                self._loadtext(f)
+                f.close()
+                try:
+                    self.compact()
+                except (IOError, OSError):
+                    # read-only repository; keep using the parsed text map
+                    pass
+                return
+            if os.fstat(f.fileno()).st_size > _HEADER.size:
+                self._file = f
+                self._data = mmap.mmap(f.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+                magic, gitcount, hgcount = _HEADER.unpack(
+                    self._data[:_HEADER.size])
+                self._bygit = _section(self._data, _HEADER.size, gitcount)
+                self._byhg = _section(self._data,
+                                      _HEADER.size + gitcount * _RECORD,
+                                      hgcount)
+            else:
+                f.close()
+        self._loadjournal()
+
+    def reload(self):
+        """Reload the files, keeping the pairs that were not flushed yet."""
+        unflushed = self._unflushed
+        self.load()
+        for pair in unflushed:
+            self.set(binascii.hexlify(pair[:20]), binascii.hexlify(pair[20:]))
+
+    def _loadtext(self, f):
+        for line in f:
+            gitsha, hgsha = line.strip().split(' ', 1)
+            self.set(gitsha, hgsha)
+
+    def _loadjournal(self):
+        if not os.path.exists(self.journalpath):
+            return
+        f = open(self.journalpath, 'rb')
+        data = f.read()
+        f.close()
+        count = len(data) // _RECORD
+        for i in xrange(count):
+            pos = i * _RECORD
+            gitbin = data[pos:pos + 20]
+            hgbin = data[pos + 20:pos + _RECORD]
+            self._newgit[gitbin] = hgbin
+            self._newhg[hgbin] = gitbin
+        self._newsorted = None
+        self._journalsize = count
+        if len(data) != count * _RECORD:
+            # drop the torn record left by an interrupted flush, so that
+            # later appends stay aligned
+            try:
+                f = open(self.journalpath, 'r+b')
+                f.truncate(count * _RECORD)
+                f.close()
+            except (IOError, OSError):
+                pass
+
+    def changed(self):
+        """Tell whether the files were written by someone else since load."""
+        if _stat(self.path) != self._stamp:
+            return True
+        journal = _stat(self.journalpath)
+        return (journal and journal[0] or 0) != self._journalsize * _RECORD
+
+    def close(self):
+        if self._file is not None:
+            self._data.close()
+            self._file.close()
+        self._file = None
+        self._data = ''
+        self._bygit = _section('', 0, 0)
+        self._byhg = _section('', 0, 0)
+
+    def __len__(self):
+        return len(self._bygit) + len([k for k in self._newgit
+                                       if self._bygit.get(k) is None])
+
+    def hg(self, gitsha):
+        """Return the hg SHA for a git SHA, or None."""
+        try:
+            key = binascii.unhexlify(gitsha)
+        except TypeError:
+            return None
+        value = self._newgit.get(key)
+        if value is None:
+            value = self._bygit.get(key)
+            if value is None:
+                return None
+        return binascii.hexlify(value)
+
+    def git(self, hgsha):
+        """Return the git SHA for an hg SHA, or None."""
+        try:
+            key = binascii.unhexlify(hgsha)
+        except TypeError:
+            return None
+        value = self._newhg.get(key)
+        if value is None:
+            value = self._byhg.get(key)
+            if value is None:
+                return None
+        return binascii.hexlify(value)
+
+    def set(self, gitsha, hgsha):
+        gitbin = binascii.unhexlify(gitsha)
+        hgbin = binascii.unhexlify(hgsha)
+        self._newgit[gitbin] = hgbin
+        self._newhg[hgbin] = gitbin
+        self._newsorted = None
+        self._unflushed.append(gitbin + hgbin)
+
+    def iterprefix(self, prefix):
+        """Iterate over (gitsha, hgsha) pairs whose git SHA has a prefix.
+
+        Only the matching range of the sorted map (and of the sorted keys
+        of the new pairs) is visited.
+        """
+        try:
+            start = binascii.unhexlify(prefix + '0' * (len(prefix) % 2))
+        except TypeError:
+            return
+        h = binascii.hexlify
+        if self._newsorted is None:
+            self._newsorted = sorted(self._newgit)
+        for keys in (self._bygit, self._newsorted):
+            i = bisect.bisect_left(keys, start)
+            while i < len(keys):
+                gitbin = keys[i]
+                if not h(gitbin).startswith(prefix):
+                    break
+                i += 1
+                if keys is self._bygit and gitbin in self._newgit:
+                    continue
+                yield h(gitbin), self.hg(h(gitbin))
+
+    def iteritems(self):
+        """Iterate over (gitsha, hgsha) pairs, ordered by git SHA."""
+        for gitbin, hgbin in _merge(self._bygit, self._newgit):
+            yield binascii.hexlify(gitbin), binascii.hexlify(hgbin)
+
+    def flush(self):
+        """Append pairs added since the last flush to the journal."""
+        if not self._unflushed:
+            return
+        f = open(self.journalpath, 'ab')
+        f.write(''.join(self._unflushed))
+        f.close()
+        self._journalsize += len(self._unflushed)
+        self._unflushed = []
+
+    def save(self):
+        """Flush new pairs, compacting the journal if it has grown large."""
+        self.flush()
+        if self._journalsize >= max(self.compactsize, len(self._bygit) // 4):
+            self.compact()
+
+    def compact(self, keep=None):
+        """Merge the journal and any new pairs into the sorted map file.
+
+        If keep is given, only pairs for which keep(gitsha, hgsha) is true
+        are written.
+        """
+        def pairs(section, new, keepfn):
+            for key, value in _merge(section, new):
+                if keep is None or keepfn(key, value):
+                    yield key, value
+        h = binascii.hexlify
+        keepgit = lambda g, s: keep(h(g), h(s))
+        keephg = lambda s, g: keep(h(g), h(s))
+
+        gitcount = sum(1 for p in pairs(self._bygit, self._newgit, keepgit))
+        hgcount = sum(1 for p in pairs(self._byhg, self._newhg, keephg))
+        file = hgutil.atomictempfile(self.path, 'wb')
+        file.write(_HEADER.pack(MAGIC, gitcount, hgcount))
+        for key, value in pairs(self._bygit, self._newgit, keepgit):
+            file.write(key + value)
+        for key, value in pairs(self._byhg, self._newhg, keephg):
+            file.write(key + value)
+        self.close()
+        # If this complains that NoneType is not callable, then
+        # atomictempfile no longer has either of rename (pre-1.9) or
+        # close (post-1.9)
+        getattr(file, 'rename', getattr(file, 'close', None))()
+        if os.path.exists(self.journalpath):
+            os.remove(self.journalpath)
+        self.load()
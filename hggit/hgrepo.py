@@ -1,17 +1,15 @@
-import os
-
 from mercurial.node import bin
 from mercurial import error
 from mercurial.i18n import _
 
-from git_handler import GitHandler
+from git_handler import gethandler
 from gitrepo import gitrepo
 
 def generate_repo_subclass(baseclass):
     class hgrepo(baseclass):
         def pull(self, remote, heads=None, force=False):
             if isinstance(remote, gitrepo):
-                git = GitHandler(self, self.ui)
+                git = gethandler(self, self.ui)
                 return git.fetch(remote.path, heads)
             else: #pragma: no cover
                 return super(hgrepo, self).pull(remote, heads, force)
@@ -19,7 +17,7 @@ def generate_repo_subclass(baseclass):
         # TODO figure out something useful to do with the newbranch param
         def push(self, remote, force=False, revs=None, newbranch=None):
             if isinstance(remote, gitrepo):
-                git = GitHandler(self, self.ui)
+                git = gethandler(self, self.ui)
                 git.push(remote.path, revs, force)
             else: #pragma: no cover
                 # newbranch was added in 1.6
@@ -31,7 +29,7 @@ def generate_repo_subclass(baseclass):
 
         def findoutgoing(self, remote, base=None, heads=None, force=False):
             if isinstance(remote, gitrepo):
-                git = GitHandler(self, self.ui)
+                git = gethandler(self, self.ui)
                 base, heads = git.get_refs(remote.path)
                 out, h = super(hgrepo, self).findoutgoing(remote, base, heads, force)
                 return out
@@ -41,7 +39,7 @@ def generate_repo_subclass(baseclass):
         def _findtags(self):
             (tags, tagtypes) = super(hgrepo, self)._findtags()
 
-            git = GitHandler(self, self.ui)
+            git = gethandler(self, self.ui)
             for tag, rev in git.tags.iteritems():
                 tags[tag] = bin(rev)
                 tagtypes[tag] = 'git'
@@ -49,13 +47,7 @@ def generate_repo_subclass(baseclass):
             return (tags, tagtypes)
 
         def gitrefs(self):
-            tagfile = self.join(os.path.join('git-remote-refs'))
-            if os.path.exists(tagfile):
-                tf = open(tagfile, 'rb')
-                tagdata = tf.read().split('\n')
-                td = [line.split(' ', 1) for line in tagdata if line]
-                return dict([(name, bin(sha)) for sha, name in td])
-            return {}
+            return dict(gethandler(self, self.ui).remote_refs)
 
         def tags(self):
             if hasattr(self, 'tagscache') and self.tagscache:
@@ -65,7 +57,7 @@ def generate_repo_subclass(baseclass):
                 # Mercurial 1.5 and later.
                 return self._tags
 
-            git = GitHandler(self, self.ui)
+            git = gethandler(self, self.ui)
             tagscache = super(hgrepo, self).tags()
             tagscache.update(self.gitrefs())
             for tag, rev in git.tags.iteritems():
@@ -90,22 +82,21 @@ def generate_repo_subclass(baseclass):
                 if not key:             # If key is STILL nonempty...
                     raise notfound
                 found = None
-                git = GitHandler(self, self.ui)
-                for gitsha, hgsha in git._map_git.iteritems(): # Check all git revs
-                    if gitsha.startswith(key):
-                        try:
-                            newfound = super(hgrepo, self).lookup(hgsha)
-                            if found: # If we find more than one key...
-                                raise error.LookupError(key, "hg-git",
-                                    _('ambiguous identifier'))
-                            else:
-                                found = newfound
-                        # hg-git knows about some revisions that hg doesn't. If these come
-                        # up in _map_git, super().lookup() will throw a RepoLookupError.
-                        # In this case we just pretend we never saw the revision.
-                        except error.RepoLookupError:
-                            pass
-                            
+                git = gethandler(self, self.ui)
+                for gitsha, hgsha in git._map.iterprefix(key): # Check matching git revs
+                    try:
+                        newfound = super(hgrepo, self).lookup(hgsha)
+                        if found: # If we find more than one key...
+                            raise error.LookupError(key, "hg-git",
+                                _('ambiguous identifier'))
+                        else:
+                            found = newfound
+                    # hg-git knows about some revisions that hg doesn't. If these come
+                    # up in _map, super().lookup() will throw a RepoLookupError.
+                    # In this case we just pretend we never saw the revision.
+                    except error.RepoLookupError:
+                        pass
+
                 if found:
                     return found
                 raise notfound # If still here, really nothing found
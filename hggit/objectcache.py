@@ -0,0 +1,275 @@
+# bounded cache of parsed git objects
+#
+# Import, tag handling and the incoming overlay read the same commits and
+# trees over and over: head commits are looked at while sorting and again
+# while walking, and each imported commit reads its parent's tree. The
+# objectcache sits in front of the object store and keeps the most
+# recently used commits and trees, each kind in its own least recently
+# used list with its own size limit. Other objects are passed through.
+#
+# Objects stored as deltas in a pack are resolved here too, rather than by
+# dulwich, through a cache of recently inflated pack entries limited by
+# their total size. Related revisions imported one after the other share
+# most of their delta chain, which is then only inflated once. Newer
+# dulwich keeps a cache of its own for each pack, but its size is fixed,
+# older versions have none, and it holds fully resolved objects only, so
+# entries are read straight from the pack files here instead.
+
+import binascii
+import zlib
+
+from dulwich.errors import ApplyDeltaError
+from dulwich.objects import Commit, ShaFile, Tree
+from dulwich.pack import apply_delta
+
+OFS_DELTA = 6
+REF_DELTA = 7
+
+def _readentryheader(f, offset):
+    f.seek(offset)
+    # long enough for the largest size and base encodings
+    header = f.read(32)
+    c = ord(header[0])
+    type_num = (c >> 4) & 7
+    size = c & 15
+    shift = 4
+    pos = 1
+    while c & 0x80:
+        c = ord(header[pos])
+        pos += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+    base = None
+    if type_num == OFS_DELTA:
+        c = ord(header[pos])
+        pos += 1
+        distance = c & 0x7f
+        while c & 0x80:
+            c = ord(header[pos])
+            pos += 1
+            distance = ((distance + 1) << 7) | (c & 0x7f)
+        base = offset - distance
+    elif type_num == REF_DELTA:
+        base = header[pos:pos + 20]
+        pos += 20
+    return type_num, size, base, header[pos:]
+
+def readpackentry(f, offset):
+    """Read the entry at offset of the open pack file f.
+
+    Returns its type number, its delta base and its inflated data. For an
+    OFS_DELTA entry the base is the offset of the base entry, for a
+    REF_DELTA entry the binary SHA of the base object, else None; the data
+    of a delta entry is the delta.
+    """
+    type_num, size, base, data = _readentryheader(f, offset)
+    decompressor = zlib.decompressobj()
+    chunks = [decompressor.decompress(data)]
+    total = len(chunks[0])
+    while total < size:
+        data = f.read(4096)
+        if not data:
+            raise zlib.error('pack entry at %d is truncated' % offset)
+        chunks.append(decompressor.decompress(data))
+        total += len(chunks[-1])
+    return type_num, base, ''.join(chunks)[:size]
+
+def readrawpackentry(f, offset):
+    """Read the entry at offset of the open pack file f without inflating
+    it for the caller.
+
+    Returns its type number, its delta base as readpackentry() does, the
+    size of its inflated data and its data as compressed in the pack.
+    """
+    type_num, size, base, data = _readentryheader(f, offset)
+    # the end of the zlib stream is only known by inflating it; a pack
+    # ends with its checksum, so some data always follows the stream
+    decompressor = zlib.decompressobj()
+    chunks = []
+    while True:
+        chunks.append(data)
+        decompressor.decompress(data)
+        if decompressor.unused_data:
+            break
+        data = f.read(4096)
+        if not data:
+            raise zlib.error('pack entry at %d is truncated' % offset)
+    data = ''.join(chunks)
+    end = len(data) - len(decompressor.unused_data)
+    return type_num, base, size, data[:end]
+
+class _lru(object):
+    """Mapping limited to size, dropping the least recently used entries to
+    make room.
+
+    By default size counts entries; with sizeof, it limits the sum of
+    sizeof(value) over all entries.
+    """
+    def __init__(self, size, sizeof=None):
+        self.size = size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        # circular doubly linked list of [prev, next, key, value], most
+        # recently used first
+        self._head = [None, None, None, None]
+        self._head[0] = self._head[1] = self._head
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _unlink(self, node):
+        node[0][1] = node[1]
+        node[1][0] = node[0]
+
+    def _pushfront(self, node):
+        head = self._head
+        node[0] = head
+        node[1] = head[1]
+        head[1][0] = node
+        head[1] = node
+
+    def get(self, key):
+        node = self._entries.get(key)
+        if node is None:
+            return None
+        self._unlink(node)
+        self._pushfront(node)
+        return node[3]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.size:
+            return
+        node = self._entries.get(key)
+        if node is not None:
+            self._unlink(node)
+            del self._entries[key]
+            self.total -= self.sizeof(node[3])
+        while self.total + size > self.size:
+            node = self._head[0]
+            self._unlink(node)
+            del self._entries[node[2]]
+            self.total -= self.sizeof(node[3])
+        node = [None, None, key, value]
+        self._entries[key] = node
+        self.total += size
+        self._pushfront(node)
+
+class objectcache(object):
+    """Read-through cache of commits and trees in front of an object store.
+
+    Objects are looked up by hex or binary SHA, like in the store. The
+    cached objects are shared, so callers must not modify them.
+    """
+    def __init__(self, store, commits=10000, trees=1000, bases=32 << 20):
+        self.store = store
+        self.commits = _lru(commits)
+        self.trees = _lru(trees)
+        self.bases = _lru(bases, lambda entry: len(entry[1]))
+        # an objectfilter answering membership checks, if any
+        self.filter = None
+        # open pack files, by pack
+        self._files = {}
+
+    def __getitem__(self, sha):
+        if len(sha) == 20:
+            sha = binascii.hexlify(sha)
+        obj = self.commits.get(sha)
+        if obj is not None:
+            self.commits.hits += 1
+            return obj
+        obj = self.trees.get(sha)
+        if obj is not None:
+            self.trees.hits += 1
+            return obj
+        obj = self._read(sha)
+        if isinstance(obj, Commit):
+            self.commits.misses += 1
+            self.commits.put(sha, obj)
+        elif isinstance(obj, Tree):
+            self.trees.misses += 1
+            self.trees.put(sha, obj)
+        return obj
+
+    def __contains__(self, sha):
+        if self.filter is not None:
+            return sha in self.filter
+        return sha in self.store
+
+    def _read(self, sha, skip=()):
+        if self.bases.size > 0:
+            binsha = binascii.unhexlify(sha)
+            found = False
+            for pack in self.store.packs:
+                try:
+                    offset = pack.index.object_index(binsha)
+                except KeyError:
+                    continue
+                found = True
+                if (pack._basename, offset) in skip:
+                    continue
+                type_num, data = self._resolve(pack, offset, skip)
+                return ShaFile.from_raw_string(type_num, data)
+            if found:
+                raise ApplyDeltaError('delta chain of %s loops' % sha)
+        return self.store[sha]
+
+    def packfile(self, pack):
+        """Return the pack's data file, opened for reading entries."""
+        f = self._files.get(pack._basename)
+        if f is None:
+            f = open(pack._basename + '.pack', 'rb')
+            self._files[pack._basename] = f
+        return f
+
+    def _resolve(self, pack, offset, skip=()):
+        """Return the type and contents of the pack entry at offset.
+
+        skip holds the entries already being resolved further up the
+        delta chain; a base that can only be found there is an error.
+        """
+        skip = set(skip)
+        # the deltas to apply, innermost first, with the entries they make
+        chain = []
+        while True:
+            key = (pack._basename, offset)
+            entry = self.bases.get(key)
+            if entry is not None:
+                self.bases.hits += 1
+                break
+            self.bases.misses += 1
+            if key in skip:
+                raise ApplyDeltaError('delta chain at %r loops' % (key,))
+            skip.add(key)
+            type_num, base, data = readpackentry(self.packfile(pack), offset)
+            if type_num not in (OFS_DELTA, REF_DELTA):
+                entry = (type_num, data)
+                self.bases.put(key, entry)
+                break
+            chain.append((key, data))
+            if type_num == OFS_DELTA:
+                offset = base
+                continue
+            try:
+                offset = pack.index.object_index(base)
+            except KeyError:
+                # the base is in another pack, or loose
+                baseobj = self._read(binascii.hexlify(base), skip)
+                entry = (baseobj.type_num, baseobj.as_raw_string())
+                break
+
+        while chain:
+            key, delta = chain.pop()
+            entry = (entry[0], ''.join(apply_delta(entry[1], delta)))
+            self.bases.put(key, entry)
+        return entry
+
+    def stats(self):
+        return ('commits: %d hits, %d misses; trees: %d hits, %d misses; '
+                'delta bases: %d hits, %d misses'
+                % (self.commits.hits, self.commits.misses,
+                   self.trees.hits, self.trees.misses,
+                   self.bases.hits, self.bases.misses))
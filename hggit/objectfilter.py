@@ -0,0 +1,148 @@
+# existence filter for the packed objects of the git object store
+#
+# Asking dulwich whether it has an object bisects the index of every pack
+# and then looks for a loose file; when the answer is no, which is common
+# for refs advertised by a remote, all of that is wasted. The filter is a
+# Bloom filter over the SHAs of all packed objects: when it says an object
+# is not packed, only the loose object directory needs checking.
+#
+# SHAs are already uniformly distributed, so the five 32-bit words of the
+# binary SHA serve directly as the filter's hash functions.
+#
+# Layout of the filter file, integers big endian:
+#   magic (8 bytes) | bit count (4 bytes) | object count (4 bytes) |
+#   pack count (4 bytes)
+#   pack count names of the packs included (20-byte binary SHAs)
+#   the filter bits
+#
+# Packs are only ever added to the filter. One that was removed by a
+# repack leaves its bits behind, which at worst turns a "no" into a "maybe"
+# that the object store then answers.
+
+import binascii
+import os
+import struct
+
+from dulwich.pack import load_pack_index
+from mercurial import util as hgutil
+
+MAGIC = 'HGGITBF1'
+_HEADER = struct.Struct('>8sLLL')
+_WORDS = struct.Struct('>5L')
+# about one false positive in a hundred
+_BITSPEROBJECT = 10
+
+class objectfilter(object):
+    """Bloom filter of the objects in the packs of a DiskObjectStore."""
+    def __init__(self, path, store):
+        self.path = path
+        self.store = store
+        self._packs = set()
+        self._count = 0
+        self._nbits = 0
+        self._bits = bytearray()
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        self._packs = set()
+        self._count = 0
+        self._nbits = 0
+        self._bits = bytearray()
+        try:
+            data = open(self.path, 'rb').read()
+        except IOError:
+            data = ''
+        if len(data) >= _HEADER.size:
+            magic, nbits, count, npacks = _HEADER.unpack_from(data, 0)
+            end = _HEADER.size + npacks * 20
+            if magic == MAGIC and len(data) == end + (nbits + 7) // 8:
+                for i in xrange(npacks):
+                    pos = _HEADER.size + i * 20
+                    self._packs.add(data[pos:pos + 20])
+                self._count = count
+                self._nbits = nbits
+                self._bits = bytearray(data[end:])
+        self.refresh()
+
+    def _packnames(self):
+        names = {}
+        for name in os.listdir(self.store.pack_dir):
+            if name.startswith('pack-') and name.endswith('.idx'):
+                try:
+                    names[binascii.unhexlify(name[5:-4])] = name
+                except TypeError:
+                    pass
+        return names
+
+    def refresh(self):
+        """Add the packs that appeared since the filter was last updated.
+
+        This must be called whenever a pack is added to the store, or the
+        filter will deny that its objects exist.
+        """
+        try:
+            names = self._packnames()
+        except OSError:
+            return
+        new = [n for n in names if n not in self._packs]
+        if not new:
+            return
+        def loadindexes(packs):
+            return [load_pack_index(os.path.join(self.store.pack_dir,
+                                                 names[n])) for n in packs]
+        indexes = loadindexes(new)
+        added = sum(len(index) for index in indexes)
+        if (self._count + added) * _BITSPEROBJECT > self._nbits:
+            # too full to stay accurate; rebuild, leaving room to grow
+            new = list(names)
+            indexes = loadindexes(new)
+            total = sum(len(index) for index in indexes)
+            self._packs = set()
+            self._count = 0
+            self._nbits = max(1 << 16, 2 * _BITSPEROBJECT * total)
+            self._bits = bytearray((self._nbits + 7) // 8)
+        for name, index in zip(new, indexes):
+            for sha in index:
+                self._add(binascii.unhexlify(sha))
+                self._count += 1
+            self._packs.add(name)
+        self._dirty = True
+
+    def _add(self, binsha):
+        bits = self._bits
+        for word in _WORDS.unpack(binsha):
+            bit = word % self._nbits
+            bits[bit >> 3] |= 1 << (bit & 7)
+
+    def maybepacked(self, sha):
+        """Tell whether a SHA may be in a pack; False is definite."""
+        if not self._nbits:
+            return bool(self._packs)
+        if len(sha) != 20:
+            sha = binascii.unhexlify(sha)
+        bits = self._bits
+        for word in _WORDS.unpack(sha):
+            bit = word % self._nbits
+            if not bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def __contains__(self, sha):
+        if not self.maybepacked(sha):
+            return self.store.contains_loose(sha)
+        return sha in self.store
+
+    def save(self):
+        if not self._dirty:
+            return
+        file = hgutil.atomictempfile(self.path, 'wb')
+        file.write(_HEADER.pack(MAGIC, self._nbits, self._count,
+                                len(self._packs)))
+        file.write(''.join(sorted(self._packs)))
+        file.write(str(self._bits))
+        # If this complains that NoneType is not callable, then
+        # atomictempfile no longer has either of rename (pre-1.9) or
+        # close (post-1.9)
+        getattr(file, 'rename', getattr(file, 'close', None))()
+        self._dirty = False
@@ -10,7 +10,7 @@ from mercurial.node import bin, hex, nullid
 class overlaymanifest(object):
     def __init__(self, repo, sha):
         self.repo = repo
-        self.tree = repo.handler.git.get_object(sha)
+        self.tree = repo.handler.objects[sha]
         self._map = None
         self._flagmap = None
 
@@ -45,7 +45,7 @@ class overlaymanifest(object):
             for entry in tree.iteritems():
                 if entry.mode & 040000:
                     # expand directory
-                    subtree = self.repo.handler.git.get_object(entry.sha)
+                    subtree = self.repo.handler.objects[entry.sha]
                     addtree(subtree, dirname + entry.path + '/')
                 else:
                     path = dirname + entry.path
@@ -85,13 +85,13 @@ class overlayfilectx(object):
         return self.fileid
 
     def data(self):
-        blob = self.repo.handler.git.get_object(self.fileid)
+        blob = self.repo.handler.objects[self.fileid]
         return blob.data
 
 class overlaychangectx(context.changectx):
     def __init__(self, repo, sha):
         self.repo = repo
-        self.commit = repo.handler.git.get_object(sha)
+        self.commit = repo.handler.objects[sha]
 
     def node(self):
         return bin(self.commit.id)
@@ -156,7 +156,7 @@ class overlayrevlog(object):
         if not gitrev:
             # we've reached a revision we have
             return self.base.parents(n)
-        commit = self.repo.handler.git.get_object(n)
+        commit = self.repo.handler.objects[n]
 
         def gitorhg(n):
             hn = self.repo.handler.map_hg_get(hex(n))
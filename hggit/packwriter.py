@@ -0,0 +1,295 @@
+# write exported git objects into packfiles
+#
+# Objects handed to a packwriter are held in memory until enough of them
+# have accumulated, then written out as a single pack through the object
+# store's add_pack(), which indexes it and makes it visible to readers.
+# Until then they can be read back from the writer itself. Like git's
+# transfer.unpackLimit, a flush of fewer than unpacklimit objects writes
+# them as loose objects instead, so that small exports do not each leave
+# a tiny pack behind for every lookup to go through.
+#
+# An object may name a base: a related object written earlier to the same
+# pack, such as the previous version of a file or of a directory tree. It
+# is then stored as a delta against that base when the delta is small
+# enough to be worth it.
+#
+# Given a worker pool, the writer compresses objects in it as they are
+# queued; zlib releases the GIL while it works, so this runs in parallel
+# with the export.
+#
+# writepack() writes the pack sent by a push. Objects that our packs store
+# as deltas keep those deltas, as long as the receiver has or is sent the
+# base, so only objects without a usable delta are deltified again. The
+# stored deltas are copied as they are compressed in our packs, so they
+# are neither searched for nor compressed a second time.
+
+import binascii
+import struct
+import zlib
+
+from dulwich.pack import create_delta
+from mercurial import util as hgutil
+
+from objectcache import readrawpackentry
+
+OFS_DELTA = 6
+REF_DELTA = 7
+
+# deltas are computed in pure Python, so only try them on small objects
+_MAXDELTASIZE = 1 << 16
+_MAXDEPTH = 50
+
+def _typeandsize(type_num, size):
+    c = (type_num << 4) | (size & 15)
+    size >>= 4
+    header = []
+    while size:
+        header.append(chr(c | 0x80))
+        c = size & 0x7f
+        size >>= 7
+    header.append(chr(c))
+    return ''.join(header)
+
+def _offset(n):
+    encoded = chr(n & 0x7f)
+    n >>= 7
+    while n:
+        n -= 1
+        encoded = chr(0x80 | (n & 0x7f)) + encoded
+        n >>= 7
+    return encoded
+
+class packwriter(object):
+    """Collect new git objects and write them to the store in packs.
+
+    Acts as an object store for the objects being exported: it has
+    add_object(), and looking objects up falls back to the real store for
+    anything not pending. A pack is written once maxbytes of object data
+    are pending, or when flush() is called. Objects are compressed in pool
+    if one is given. Fewer than unpacklimit objects are written loose.
+    """
+    def __init__(self, store, maxbytes=64 << 20, pool=None, unpacklimit=0):
+        self.store = store
+        self.maxbytes = maxbytes
+        self.pool = pool
+        self.unpacklimit = unpacklimit
+        self._pending = {}
+        self._order = []
+        self._bytes = 0
+
+    def __contains__(self, sha):
+        return sha in self._pending or sha in self.store
+
+    def __getitem__(self, sha):
+        pending = self._pending.get(sha)
+        if pending is not None:
+            return pending[0]
+        return self.store[sha]
+
+    def __len__(self):
+        return len(self._order)
+
+    def ispending(self, sha):
+        return sha in self._pending
+
+    def add_object(self, obj, base=None):
+        """Queue an object, optionally as a delta against base (a SHA)."""
+        sha = obj.id
+        if sha in self._pending:
+            return
+        raw = obj.as_raw_string()
+        delta = None
+        depth = 0
+        based = self._pending.get(base)
+        if (based is not None and based[0].type_num == obj.type_num
+            and based[3] < _MAXDEPTH and len(raw) <= _MAXDELTASIZE
+            and len(based[0].as_raw_string()) <= _MAXDELTASIZE):
+            delta = create_delta(based[0].as_raw_string(), raw)
+            if not isinstance(delta, str):
+                delta = ''.join(delta)
+            if len(delta) < len(raw) // 2:
+                depth = based[3] + 1
+            else:
+                delta = None
+        compressed = None
+        if self.pool is not None:
+            compressed = self.pool.apply_async(zlib.compress, (delta or raw,))
+        self._pending[sha] = (obj, delta is not None and base or None,
+                              delta, depth, compressed)
+        self._order.append(sha)
+        self._bytes += len(delta or raw)
+
+    def full(self):
+        return self._bytes >= self.maxbytes
+
+    def flush(self):
+        """Write the pending objects to a new pack in the store."""
+        if not self._order:
+            return
+        if len(self._order) < self.unpacklimit:
+            for sha in self._order:
+                self.store.add_object(self._pending[sha][0])
+            self.discard()
+            return
+        result = self.store.add_pack()
+        f, commit = result[0], result[1]
+        sha1 = hgutil.sha1()
+        offsets = {}
+        pos = [0]
+        def write(data):
+            f.write(data)
+            sha1.update(data)
+            pos[0] += len(data)
+
+        write('PACK' + struct.pack('>LL', 2, len(self._order)))
+        for sha in self._order:
+            obj, base, delta, depth, compressed = self._pending[sha]
+            offsets[sha] = pos[0]
+            data = delta or obj.as_raw_string()
+            if compressed is not None:
+                compressed = compressed.get()
+            else:
+                compressed = zlib.compress(data)
+            if delta is not None:
+                write(_typeandsize(OFS_DELTA, len(delta)) +
+                      _offset(offsets[sha] - offsets[base]) + compressed)
+            else:
+                write(_typeandsize(obj.type_num, len(data)) + compressed)
+        f.write(sha1.digest())
+        commit()
+        self.discard()
+
+    def discard(self):
+        """Forget the pending objects without writing them."""
+        self._pending = {}
+        self._order = []
+        self._bytes = 0
+
+def _storeddelta(store, binsha, files, bases, available):
+    """Return the base a pack of store keeps binsha as a delta against, if
+    it is in available, with the size of the delta and the delta as
+    compressed in the pack; else (None, None, None).
+
+    Pack entries are read raw from the files opened in files, by pack.
+    bases caches, per pack, the offsets of the available objects in it.
+    """
+    for pack in store.packs:
+        try:
+            offset = pack.index.object_index(binsha)
+        except KeyError:
+            continue
+        key = pack._basename
+        f = files.get(key)
+        if f is None:
+            f = files[key] = open(key + '.pack', 'rb')
+        type_num, base, size, delta = readrawpackentry(f, offset)
+        if type_num == OFS_DELTA:
+            if key not in bases:
+                offsets = {}
+                for sha in available:
+                    try:
+                        offsets[pack.index.object_index(
+                            binascii.unhexlify(sha))] = sha
+                    except KeyError:
+                        pass
+                bases[key] = offsets
+            base = bases[key].get(base)
+        elif type_num == REF_DELTA:
+            base = binascii.hexlify(base)
+            if base not in available:
+                base = None
+        else:
+            base = None
+        if base is None:
+            return None, None, None
+        return base, size, delta
+    return None, None, None
+
+def writepack(f, objects, store, available, reused=None):
+    """Write the (object, path) pairs in objects to f as a pack.
+
+    Objects store keeps as deltas against an object in available, the
+    SHAs of the objects the receiver has or is being sent, are written as
+    those deltas. Other objects may be deltified against the previous
+    object written for their path. Returns a map of the written SHAs to
+    their offsets and CRC32s, and the pack checksum. If reused is given,
+    the SHAs of the objects written as stored deltas are added to it.
+    """
+    objects = list(objects)
+    available = set(available)
+    available.update(obj.id for obj, path in objects)
+    sha1 = hgutil.sha1()
+    entries = {}
+    files = {}
+    bases = {}
+    bypath = {}
+    deltabases = {}
+    pos = [0]
+    def write(data):
+        f.write(data)
+        sha1.update(data)
+        pos[0] += len(data)
+    def depth(sha, base):
+        # how long the chain of deltas through base would be, or None if
+        # base already leads back to sha: packs may store two objects as
+        # deltas against each other, and the receiver could resolve neither
+        n = 0
+        while base is not None:
+            if base == sha:
+                return None
+            base = deltabases.get(base)
+            n += 1
+        return n
+
+    try:
+        write('PACK' + struct.pack('>LL', 2, len(objects)))
+        for obj, path in objects:
+            sha = obj.id
+            base, size, stored = _storeddelta(store, binascii.unhexlify(sha),
+                                              files, bases, available)
+            if stored is not None:
+                n = depth(sha, base)
+                if n is None or n > _MAXDEPTH:
+                    base = stored = None
+                elif reused is not None:
+                    reused.add(sha)
+            raw = obj.as_raw_string()
+            delta = None
+            if stored is None:
+                based = None
+                if path is not None:
+                    based = bypath.get(path)
+                if (based is not None and based[0].type_num == obj.type_num
+                    and len(raw) <= _MAXDELTASIZE
+                    and len(based[1]) <= _MAXDELTASIZE):
+                    n = depth(sha, based[0].id)
+                    if n is not None and n <= _MAXDEPTH:
+                        delta = create_delta(based[1], raw)
+                        if not isinstance(delta, str):
+                            delta = ''.join(delta)
+                        if len(delta) < len(raw) // 2:
+                            base = based[0].id
+                        else:
+                            delta = None
+            if path is not None:
+                bypath[path] = (obj, raw)
+            offset = pos[0]
+            if stored is not None:
+                deltabases[sha] = base
+                data = (_typeandsize(REF_DELTA, size) +
+                        binascii.unhexlify(base) + stored)
+            elif delta is not None:
+                deltabases[sha] = base
+                data = (_typeandsize(REF_DELTA, len(delta)) +
+                        binascii.unhexlify(base) + zlib.compress(delta))
+            else:
+                data = (_typeandsize(obj.type_num, len(raw)) +
+                        zlib.compress(raw))
+            write(data)
+            entries[sha] = (offset, binascii.crc32(data) & 0xffffffff)
+    finally:
+        for packfile in files.itervalues():
+            packfile.close()
+    digest = sha1.digest()
+    f.write(digest)
+    return entries, digest
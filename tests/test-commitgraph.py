@@ -0,0 +1,159 @@
+import os, sys, tempfile, shutil
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from hggit.commitgraph import commitgraph, UNKNOWN
+
+def sha(n):
+    return ('%x' % n) * 40
+
+class TestCommitGraph(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp('hg-git_commitgraph-test')
+        self.path = os.path.join(self.tmpdir, 'hg-git-commit-graph')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertEquals(self, l, r):
+        print '%% expect %r' % (r, )
+        print l
+        assert l == r
+
+    def build(self):
+        # 1 - 2 - 4 - 5
+        #  \- 3 -/   /
+        #   \- 6 ---/
+        g = commitgraph(self.path)
+        g.add(sha(1), [], 100, 0)
+        g.add(sha(2), [sha(1)], 200, -3600)
+        g.add(sha(3), [sha(1)], 300, 0)
+        g.add(sha(4), [sha(2), sha(3)], 400, 0)
+        g.add(sha(6), [sha(1)], 500, 0)
+        g.add(sha(5), [sha(4), sha(6), sha(1)], 600, 0)
+        return g
+
+    def check(self, g):
+        self.assertEquals(len(g), 6)
+        self.assertEquals(g.parents(sha(4)), [sha(2), sha(3)])
+        self.assertEquals(g.parents(sha(5)), [sha(4), sha(6), sha(1)])
+        self.assertEquals(g.parents(sha(1)), [])
+        self.assertEquals(g.committime(sha(2)), (200, -3600))
+        self.assertEquals([g.generation(sha(n)) for n in range(1, 7)],
+                          [1, 2, 2, 3, 4, 2])
+        self.assertEquals(g.isancestor(sha(3), sha(5)), True)
+        self.assertEquals(g.isancestor(sha(5), sha(3)), False)
+        self.assertEquals(g.isancestor(sha(6), sha(4)), False)
+        self.assertEquals(g.isancestor(sha(4), sha(4)), True)
+        self.assertEquals(sha(7) in g, False)
+
+    def test_memory(self):
+        self.check(self.build())
+
+    def test_saved(self):
+        self.build().save()
+        self.check(commitgraph(self.path))
+
+    def test_incremental(self):
+        g = commitgraph(self.path)
+        g.add(sha(1), [], 100, 0)
+        g.add(sha(3), [sha(1)], 300, 0)
+        g.save()
+        g = commitgraph(self.path)
+        g.add(sha(2), [sha(1)], 200, -3600)
+        g.add(sha(4), [sha(2), sha(3)], 400, 0)
+        g.save()
+        g = commitgraph(self.path)
+        g.add(sha(6), [sha(1)], 500, 0)
+        g.add(sha(5), [sha(4), sha(6), sha(1)], 600, 0)
+        g.save()
+        self.check(commitgraph(self.path))
+
+    def test_journal(self):
+        g = commitgraph(self.path)
+        g.add(sha(1), [], 100, 0)
+        g.add(sha(3), [sha(1)], 300, 0)
+        g.save()
+        g.add(sha(2), [sha(1)], 200, -3600)
+        g.add(sha(4), [sha(2), sha(3)], 400, 0)
+        g.save()
+        # saving appends to the journal and leaves the graph file alone
+        self.assertEquals(os.path.exists(g.path), False)
+        g = commitgraph(self.path)
+        g.add(sha(6), [sha(1)], 500, 0)
+        g.add(sha(5), [sha(4), sha(6), sha(1)], 600, 0)
+        g.save()
+        self.check(commitgraph(self.path))
+        g = commitgraph(self.path)
+        g.compact()
+        self.assertEquals(os.path.exists(g.journalpath), False)
+        self.check(commitgraph(self.path))
+        # new commits go on from the compacted file
+        g.add(sha(7), [sha(5)], 700, 0)
+        g.save()
+        g = commitgraph(self.path)
+        self.assertEquals(g.generation(sha(7)), 5)
+        self.assertEquals(g.isancestor(sha(3), sha(7)), True)
+        self.assertEquals(len(g), 7)
+
+    def test_torn_journal(self):
+        self.build().save()
+        f = open(self.path + '.journal', 'ab')
+        f.write('x' * 10)
+        f.close()
+        g = commitgraph(self.path)
+        self.check(g)
+        g.add(sha(7), [sha(5)], 700, 0)
+        g.save()
+        self.assertEquals(commitgraph(self.path).parents(sha(7)), [sha(5)])
+
+    def test_concurrent(self):
+        g = commitgraph(self.path)
+        g.add(sha(1), [], 100, 0)
+        g.save()
+        other = commitgraph(self.path)
+        other.add(sha(2), [sha(1)], 200, -3600)
+        other.add(sha(3), [sha(1)], 300, 0)
+        other.save()
+        g.add(sha(4), [sha(2), sha(3)], 400, 0)
+        g.add(sha(6), [sha(1)], 500, 0)
+        g.add(sha(5), [sha(4), sha(6), sha(1)], 600, 0)
+        g.save()
+        self.check(commitgraph(self.path))
+
+    def test_unknown_parent(self):
+        # 8 is not in the graph, as at the edge of a shallow clone:
+        # 1 - 2 - 3 - 4
+        #     8 -/   /
+        # 9 --------/
+        g = commitgraph(self.path)
+        g.add(sha(1), [], 100, 0)
+        g.add(sha(2), [sha(1)], 200, 0)
+        g.add(sha(3), [sha(2), sha(8)], 300, 0)
+        g.add(sha(9), [], 350, 0)
+        g.add(sha(4), [sha(3), sha(9)], 400, 0)
+        g.save()
+        g = commitgraph(self.path)
+        self.assertEquals(sha(8) in g, False)
+        self.assertEquals(g.parents(sha(3)), [sha(2)])
+        self.assertEquals([g.generation(sha(n)) for n in (1, 2, 3, 9, 4)],
+                          [1, 2, UNKNOWN, 1, UNKNOWN])
+        # a generation above that of 9 must not hide it
+        self.assertEquals(g.isancestor(sha(9), sha(4)), True)
+        self.assertEquals(g.isancestor(sha(1), sha(4)), True)
+        self.assertEquals(g.isancestor(sha(3), sha(2)), False)
+        # 9 may still be an ancestor of 3 through 8
+        self.assertEquals(g.isancestor(sha(9), sha(3)), None)
+
+if __name__ == '__main__':
+    tc = TestCommitGraph()
+    for test in ['test_memory',
+                 'test_saved',
+                 'test_incremental',
+                 'test_journal',
+                 'test_torn_journal',
+                 'test_concurrent',
+                 'test_unknown_parent']:
+        tc.setUp()
+        getattr(tc, test)()
+        tc.tearDown()
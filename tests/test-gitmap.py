@@ -0,0 +1,140 @@
+import os, sys, tempfile, shutil
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from hggit.gitmap import gitmap, MAGIC
+
+GIT1 = '1' * 40
+GIT2 = '2' * 40
+GIT3 = '3' * 40
+HG1 = 'a' * 40
+HG2 = 'b' * 40
+HG3 = 'c' * 40
+
+class TestGitMap(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp('hg-git_gitmap-test')
+        self.path = os.path.join(self.tmpdir, 'git-mapfile')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertEquals(self, l, r):
+        print '%% expect %r' % (r, )
+        print l
+        assert l == r
+
+    def test_roundtrip(self):
+        m = gitmap(self.path)
+        m.set(GIT2, HG1)
+        m.set(GIT1, HG2)
+        self.assertEquals(m.hg(GIT2), HG1)
+        self.assertEquals(m.git(HG2), GIT1)
+        m.compact()
+        self.assertEquals(open(self.path, 'rb').read(8), MAGIC)
+        m = gitmap(self.path)
+        self.assertEquals(len(m), 2)
+        self.assertEquals(m.hg(GIT1), HG2)
+        self.assertEquals(m.git(HG1), GIT2)
+        self.assertEquals(m.hg(GIT3), None)
+        self.assertEquals(m.git(HG3), None)
+
+    def test_merge_new_entries(self):
+        m = gitmap(self.path)
+        m.set(GIT1, HG1)
+        m.set(GIT3, HG3)
+        m.compact()
+        m.set(GIT2, HG2)
+        self.assertEquals(m.hg(GIT2), HG2)
+        self.assertEquals([g for g, h in m.iteritems()], [GIT1, GIT2, GIT3])
+        m.compact()
+        m = gitmap(self.path)
+        self.assertEquals(list(m.iteritems()),
+                          [(GIT1, HG1), (GIT2, HG2), (GIT3, HG3)])
+
+    def test_upgrade_text_map(self):
+        f = open(self.path, 'wb')
+        f.write('%s %s\n%s %s\n' % (GIT1, HG1, GIT2, HG2))
+        f.close()
+        m = gitmap(self.path)
+        self.assertEquals(open(self.path, 'rb').read(8), MAGIC)
+        self.assertEquals(m.hg(GIT1), HG1)
+        self.assertEquals(m.git(HG2), GIT2)
+
+    def test_prune(self):
+        m = gitmap(self.path)
+        m.set(GIT1, HG1)
+        m.set(GIT2, HG2)
+        m.save()
+        m.compact(keep=lambda gitsha, hgsha: hgsha != HG1)
+        m = gitmap(self.path)
+        self.assertEquals(m.hg(GIT1), None)
+        self.assertEquals(m.git(HG1), None)
+        self.assertEquals(m.git(HG2), GIT2)
+
+    def test_journal(self):
+        m = gitmap(self.path, compactsize=3)
+        m.set(GIT1, HG1)
+        m.set(GIT2, HG2)
+        m.save()
+        self.assertEquals(os.path.exists(self.path), False)
+        self.assertEquals(os.path.getsize(m.journalpath), 80)
+        # a torn record from an interrupted flush is dropped
+        f = open(m.journalpath, 'ab')
+        f.write('x' * 10)
+        f.close()
+        m = gitmap(self.path, compactsize=3)
+        self.assertEquals(m.hg(GIT2), HG2)
+        self.assertEquals(os.path.getsize(m.journalpath), 80)
+        m.set(GIT3, HG3)
+        m.save()
+        self.assertEquals(os.path.exists(m.journalpath), False)
+        m = gitmap(self.path)
+        self.assertEquals(list(m.iteritems()),
+                          [(GIT1, HG1), (GIT2, HG2), (GIT3, HG3)])
+
+    def test_prefix(self):
+        m = gitmap(self.path)
+        m.set('12' + '0' * 38, HG1)
+        m.set('13' + '0' * 38, HG2)
+        m.compact()
+        m.set('123' + '0' * 37, HG3)
+        self.assertEquals(sorted(h for g, h in m.iterprefix('12')),
+                          [HG1, HG3])
+        self.assertEquals([h for g, h in m.iterprefix('13')], [HG2])
+        self.assertEquals([h for g, h in m.iterprefix('123')], [HG3])
+        self.assertEquals(list(m.iterprefix('4')), [])
+        self.assertEquals(list(m.iterprefix('tip')), [])
+
+    def test_reload(self):
+        # two handlers on the same repository, each with its own map
+        a = gitmap(self.path)
+        b = gitmap(self.path)
+        a.set(GIT1, HG1)
+        a.flush()
+        b.set(GIT2, HG2)
+        self.assertEquals(b.changed(), True)
+        b.reload()
+        self.assertEquals(b.changed(), False)
+        self.assertEquals(b.hg(GIT1), HG1)
+        self.assertEquals(b.hg(GIT2), HG2)
+        b.flush()
+        a.set(GIT3, HG3)
+        a.reload()
+        a.save()
+        m = gitmap(self.path)
+        self.assertEquals(list(m.iteritems()),
+                          [(GIT1, HG1), (GIT2, HG2), (GIT3, HG3)])
+
+if __name__ == '__main__':
+    tc = TestGitMap()
+    for test in ['test_roundtrip',
+                 'test_merge_new_entries',
+                 'test_upgrade_text_map',
+                 'test_prune',
+                 'test_journal',
+                 'test_prefix',
+                 'test_reload']:
+        tc.setUp()
+        getattr(tc, test)()
+        tc.tearDown()
@@ -0,0 +1,104 @@
+import os, sys, tempfile, shutil, subprocess
+from multiprocessing.pool import ThreadPool
+from mercurial import ui, hg, commands, util
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from hggit import git_handler
+from hggit.git_handler import GitHandler
+
+for var in ('AUTHOR', 'COMMITTER'):
+    os.environ['GIT_%s_NAME' % var] = 'test'
+    os.environ['GIT_%s_EMAIL' % var] = 'test@example.org'
+    os.environ['GIT_%s_DATE' % var] = '2007-01-01 00:00:00 +0000'
+
+def git(repo, *args, **kwargs):
+    proc = subprocess.Popen(['git', '--git-dir=' + repo] + list(args),
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out = proc.communicate(kwargs.get('input'))[0]
+    assert proc.returncode == 0
+    return out
+
+class recordingpool(ThreadPool):
+    """ThreadPool remembering its instances."""
+    pools = []
+
+    def __init__(self, *args, **kwargs):
+        ThreadPool.__init__(self, *args, **kwargs)
+        self.terminated = False
+        self.pools.append(self)
+
+    def terminate(self):
+        ThreadPool.terminate(self)
+        self.terminated = True
+
+class failinghandler(GitHandler):
+    """GitHandler whose reader fails on the commit named fail."""
+    fail = None
+
+    def _readimportcommit(self, sha):
+        if self.objects[sha].message == self.fail:
+            raise util.Abort('cannot read %s' % self.fail.strip())
+        return GitHandler._readimportcommit(self, sha)
+
+class TestImportPool(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp('hg-git_import-pool-test')
+        hgrepo = os.path.join(self.tmpdir, 'hgrepo')
+        commands.init(ui.ui(), hgrepo)
+        self.ui = ui.ui()
+        self.ui.setconfig('git', 'importbatch', '2')
+        self.ui.setconfig('git', 'importahead', '8')
+        self.repo = hg.repository(self.ui, hgrepo)
+        self.handler = failinghandler(self.repo, self.ui)
+        self.handler.init_if_missing()
+        gitdir = self.handler.gitdir
+        parents = []
+        for n in range(5):
+            blob = git(gitdir, 'hash-object', '-w', '--stdin',
+                       input='file %d\n' % n).strip()
+            tree = git(gitdir, 'mktree',
+                       input='100644 blob %s\tfile%d\n' % (blob, n)).strip()
+            args = ['commit-tree', tree] + ['-p' + p for p in parents]
+            parents = [git(gitdir, *args, input='commit %d\n' % n).strip()]
+        self.refs = {'refs/heads/master': parents[0]}
+        recordingpool.pools = []
+        git_handler.ThreadPool = recordingpool
+
+    def tearDown(self):
+        git_handler.ThreadPool = ThreadPool
+        shutil.rmtree(self.tmpdir)
+
+    def assertEquals(self, l, r):
+        print '%% expect %r' % (r, )
+        print l
+        assert l == r
+
+    def test_worker_fails(self):
+        self.handler.fail = 'commit 3\n'
+        try:
+            self.handler.import_git_objects(refs=self.refs)
+        except util.Abort, e:
+            print 'abort: %s' % e
+        # the batch the failure happened in was rolled back
+        self.assertEquals(len(self.repo), 2)
+        self.assertEquals(len(list(self.handler._map.iteritems())), 2)
+        # and the pool shut down, without a worker left running
+        pools = recordingpool.pools
+        self.assertEquals(len(pools), 1)
+        self.assertEquals(pools[0].terminated, True)
+        self.assertEquals([t for t in pools[0]._pool if t.is_alive()], [])
+        # the import can be resumed
+        self.handler.fail = None
+        self.handler.import_git_objects(refs=self.refs)
+        self.assertEquals([self.repo[r].description() for r in self.repo],
+                          ['commit %d' % n for n in range(5)])
+        self.assertEquals(len(list(self.handler._map.iteritems())), 5)
+        self.assertEquals(pools[1].terminated, True)
+
+if __name__ == '__main__':
+    tc = TestImportPool()
+    for test in ['test_worker_fails']:
+        tc.setUp()
+        getattr(tc, test)()
+        tc.tearDown()
@@ -0,0 +1,84 @@
+import os, sys, tempfile, shutil
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from dulwich.objects import Blob
+from dulwich.repo import Repo
+
+from hggit.objectfilter import objectfilter
+from hggit.packwriter import packwriter
+
+def blobs(start, count):
+    return [Blob.from_string('blob %d\n' % n)
+            for n in range(start, start + count)]
+
+def addpack(store, objects):
+    writer = packwriter(store)
+    for obj in objects:
+        writer.add_object(obj)
+    writer.flush()
+
+class TestObjectFilter(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp('hg-git_objectfilter-test')
+        self.store = Repo.init_bare(self.tmpdir).object_store
+        self.path = os.path.join(self.tmpdir, 'hg-git-object-filter')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertEquals(self, l, r):
+        print '%% expect %r' % (r, )
+        print l
+        assert l == r
+
+    def test_roundtrip(self):
+        packed = blobs(0, 100)
+        addpack(self.store, packed)
+        f = objectfilter(self.path, self.store)
+        self.assertEquals(all(f.maybepacked(b.id) for b in packed), True)
+        f.save()
+        self.assertEquals(os.path.exists(self.path), True)
+        f = objectfilter(self.path, self.store)
+        self.assertEquals(f._dirty, False)
+        self.assertEquals(all(f.maybepacked(b.id) for b in packed), True)
+        self.assertEquals(all(b.id in f for b in packed), True)
+        missing = blobs(100, 100)
+        self.assertEquals(len([b for b in missing if f.maybepacked(b.id)])
+                          < 10, True)
+        self.assertEquals(any(b.id in f for b in missing), False)
+        # loose objects are not in the filter, but still found
+        loose = blobs(200, 1)[0]
+        self.store.add_object(loose)
+        self.assertEquals(loose.id in f, True)
+
+    def test_new_packs(self):
+        f = objectfilter(self.path, self.store)
+        f.save()
+        packed = blobs(0, 10)
+        addpack(self.store, packed)
+        # the filter only learns about a pack when refreshed
+        f.refresh()
+        self.assertEquals(all(b.id in f for b in packed), True)
+        # a filter saved before the pack was added catches up on load
+        f = objectfilter(self.path, self.store)
+        self.assertEquals(all(b.id in f for b in packed), True)
+        f.save()
+        # enough objects to force the filter to be rebuilt larger
+        nbits = f._nbits
+        more = blobs(10, 7000)
+        addpack(self.store, more)
+        f.refresh()
+        self.assertEquals(f._nbits > nbits, True)
+        f.save()
+        f = objectfilter(self.path, self.store)
+        self.assertEquals(all(f.maybepacked(b.id) for b in packed + more),
+                          True)
+
+if __name__ == '__main__':
+    tc = TestObjectFilter()
+    for test in ['test_roundtrip',
+                 'test_new_packs']:
+        tc.setUp()
+        getattr(tc, test)()
+        tc.tearDown()
@@ -0,0 +1,178 @@
+import hashlib, os, sys, tempfile, shutil, struct, zlib
+from cStringIO import StringIO
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from dulwich.objects import Blob, Tree
+from dulwich.pack import (PackData, create_delta, load_pack_index,
+                          write_pack_index_v2)
+from dulwich.repo import Repo
+
+from hggit.objectcache import readpackentry, readrawpackentry
+from hggit.packwriter import REF_DELTA, _typeandsize, packwriter, writepack
+
+def blob(n):
+    return Blob.from_string(''.join('line %d\n' % i
+                                    for i in range(100 + n)))
+
+def packfiles(store):
+    return sorted(name for name in os.listdir(store.pack_dir)
+                  if name.endswith('.pack'))
+
+def refdeltapack(store, obj, base, level=6):
+    """Write a pack holding only obj, as a delta against base compressed
+    at level; return the delta."""
+    delta = create_delta(base.as_raw_string(), obj.as_raw_string())
+    if not isinstance(delta, str):
+        delta = ''.join(delta)
+    entry = (_typeandsize(REF_DELTA, len(delta)) + base.sha().digest() +
+             zlib.compress(delta, level))
+    data = 'PACK' + struct.pack('>LL', 2, 1) + entry
+    checksum = hashlib.sha1(data).digest()
+    name = os.path.join(store.pack_dir, 'pack-' + checksum.encode('hex'))
+    f = open(name + '.pack', 'wb')
+    f.write(data + checksum)
+    f.close()
+    f = open(name + '.idx', 'wb')
+    write_pack_index_v2(f, [(obj.sha().digest(), 12,
+                             zlib.crc32(entry) & 0xffffffff)], checksum)
+    f.close()
+    return delta
+
+def readentries(data, entries):
+    """Return the type and base of the entries of a written pack."""
+    f = StringIO(data)
+    result = {}
+    for sha, (offset, crc32) in entries.iteritems():
+        type_num, base, d = readpackentry(f, offset)
+        result[sha] = type_num, base and base.encode('hex')
+    return result
+
+class TestPackWriter(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp('hg-git_packwriter-test')
+        self.store = Repo.init_bare(self.tmpdir).object_store
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertEquals(self, l, r):
+        print '%% expect %r' % (r, )
+        print l
+        assert l == r
+
+    def test_readback(self):
+        b = [blob(n) for n in range(4)]
+        tree = Tree()
+        tree.add('file', 0100644, b[-1].id)
+        writer = packwriter(self.store)
+        writer.add_object(b[0])
+        for n in range(1, len(b)):
+            writer.add_object(b[n], b[n - 1].id)
+        writer.add_object(tree)
+        self.assertEquals(writer[b[2].id].data == b[2].data, True)
+        writer.flush()
+        self.assertEquals(len(writer), 0)
+        names = packfiles(self.store)
+        self.assertEquals(len(names), 1)
+        path = os.path.join(self.store.pack_dir, names[0][:-5])
+        data = PackData(path + '.pack')
+        index = load_pack_index(path + '.idx')
+        self.assertEquals(len(data), 5)
+        self.assertEquals(sorted(index), sorted(o.id for o in b + [tree]))
+        data.check()
+        self.assertEquals(index.get_pack_checksum() ==
+                          data.get_stored_checksum(), True)
+        # later versions were stored as deltas against earlier ones
+        deltas = [u for u in data.iterobjects() if u[1] == 6]
+        self.assertEquals(len(deltas), 3)
+        for obj in b + [tree]:
+            self.assertEquals(self.store[obj.id].as_raw_string() ==
+                              obj.as_raw_string(), True)
+
+    def test_discard(self):
+        writer = packwriter(self.store)
+        writer.add_object(blob(1))
+        writer.discard()
+        self.assertEquals(len(writer), 0)
+        self.assertEquals(blob(1).id in writer, False)
+        writer.flush()
+        self.assertEquals(packfiles(self.store), [])
+
+    def test_unpacklimit(self):
+        b = [blob(n) for n in range(3)]
+        writer = packwriter(self.store, unpacklimit=3)
+        writer.add_object(b[0])
+        writer.add_object(b[1], b[0].id)
+        writer.flush()
+        # too few objects for a pack of their own
+        self.assertEquals(packfiles(self.store), [])
+        self.assertEquals([self.store.contains_loose(x.id) for x in b[:2]],
+                          [True, True])
+        for x in b:
+            writer.add_object(x)
+        writer.flush()
+        self.assertEquals(len(packfiles(self.store)), 1)
+
+    def test_reuse_stored_delta(self):
+        b = [blob(n) for n in range(3)]
+        writer = packwriter(self.store)
+        for n in range(len(b)):
+            writer.add_object(b[n], n and b[n - 1].id or None)
+        writer.flush()
+        # b1 is stored as a delta against b0, which the receiver has; b2
+        # is stored as a delta against b1, which it gets
+        f = StringIO()
+        reused = set()
+        entries, digest = writepack(f, [(b[2], None), (b[1], None)],
+                                    self.store, [b[0].id], reused)
+        self.assertEquals(sorted(reused), sorted([b[1].id, b[2].id]))
+        self.assertEquals(readentries(f.getvalue(), entries),
+                          {b[1].id: (REF_DELTA, b[0].id),
+                           b[2].id: (REF_DELTA, b[1].id)})
+        # without the base, the object is written whole
+        f = StringIO()
+        reused = set()
+        entries, digest = writepack(f, [(b[1], None)], self.store, [],
+                                    reused)
+        self.assertEquals(reused, set())
+        self.assertEquals(readentries(f.getvalue(), entries),
+                          {b[1].id: (3, None)})
+
+    def test_delta_loop(self):
+        # two packs store x and y as deltas against each other
+        x, y = blob(1), blob(2)
+        refdeltapack(self.store, x, y)
+        refdeltapack(self.store, y, x)
+        f = StringIO()
+        reused = set()
+        entries, digest = writepack(f, [(x, None), (y, None)], self.store,
+                                    [], reused)
+        self.assertEquals(sorted(reused), [x.id])
+        self.assertEquals(readentries(f.getvalue(), entries),
+                          {x.id: (REF_DELTA, y.id), y.id: (3, None)})
+
+    def test_copy_stored_delta(self):
+        # stored uncompressed, so recompressing would change the bytes
+        x, y = blob(1), blob(2)
+        delta = refdeltapack(self.store, y, x, level=0)
+        f = StringIO()
+        entries, digest = writepack(f, [(y, None)], self.store, [x.id])
+        offset = entries[y.id][0]
+        type_num, base, size, data = readrawpackentry(f, offset)
+        self.assertEquals((type_num, base.encode('hex'), size),
+                          (REF_DELTA, x.id, len(delta)))
+        self.assertEquals(data == zlib.compress(delta, 0), True)
+        self.assertEquals(readpackentry(f, offset)[2] == delta, True)
+
+if __name__ == '__main__':
+    tc = TestPackWriter()
+    for test in ['test_readback',
+                 'test_discard',
+                 'test_unpacklimit',
+                 'test_reuse_stored_delta',
+                 'test_delta_loop',
+                 'test_copy_stored_delta']:
+        tc.setUp()
+        getattr(tc, test)()
+        tc.tearDown()
@@ -0,0 +1,68 @@
+import os, sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from mercurial import ui as uimod
+
+from hggit import _ssh
+
+# ignore the user's configuration
+os.environ['HGRCPATH'] = ''
+
+class TestMultiplexOpts(object):
+    def setUp(self):
+        self.ui = uimod.ui()
+
+    def tearDown(self):
+        pass
+
+    def assertEquals(self, l, r):
+        print '%% expect %r' % (r, )
+        print l
+        assert l == r
+
+    def opts(self, host='example.com', username='git', port=None,
+             sshcmd='ssh'):
+        """Return the options, with the control directory and process id
+        replaced by placeholders."""
+        opts = _ssh._multiplexopts(self.ui, sshcmd, host, username, port)
+        opts = opts.replace(_ssh._controldir() + os.sep, '<controldir>/')
+        return opts.replace("/%d-" % os.getpid(), '/<pid>-')
+
+    def controlpath(self, opts):
+        return opts.split('ControlPath=')[1].split("'")[0]
+
+    def test_private(self):
+        self.assertEquals(self.opts(),
+                          "-o ControlMaster=auto "
+                          "-o 'ControlPath=<controldir>/<pid>-"
+                          "0ee7330db9252837' -o ControlPersist=60")
+        # short enough for a socket address wherever the tmpdir is
+        path = _ssh._multiplexopts(self.ui, 'ssh', 'a' * 200, 'b' * 200, 22)
+        self.assertEquals(len(os.path.basename(self.controlpath(path))) <=
+                          len('%d-' % os.getpid()) + 16, True)
+
+    def test_persist(self):
+        self.ui.setconfig('git', 'sshpersist', '300')
+        opts = self.opts()
+        self.assertEquals('<pid>' in opts, False)
+        self.assertEquals(opts.endswith('-o ControlPersist=300'), True)
+        # one socket per destination
+        self.assertEquals(self.opts() == opts, True)
+        self.assertEquals(self.opts(port=2222) == opts, False)
+        self.assertEquals(self.opts(username='other') == opts, False)
+        self.assertEquals(self.opts(host='example.org') == opts, False)
+
+    def test_disabled(self):
+        self.assertEquals(self.opts(sshcmd='plink -batch'), '')
+        self.ui.setconfig('git', 'sshmultiplex', 'false')
+        self.assertEquals(self.opts(), '')
+
+if __name__ == '__main__':
+    tc = TestMultiplexOpts()
+    for test in ['test_private',
+                 'test_persist',
+                 'test_disabled']:
+        tc.setUp()
+        getattr(tc, test)()
+        tc.tearDown()
@@ -0,0 +1,128 @@
+import inspect, os, sys, tempfile, shutil, struct, subprocess
+from mercurial import ui, hg, commands
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from hggit.git_handler import GitHandler
+
+for var in ('AUTHOR', 'COMMITTER'):
+    os.environ['GIT_%s_NAME' % var] = 'test'
+    os.environ['GIT_%s_EMAIL' % var] = 'test@example.org'
+    os.environ['GIT_%s_DATE' % var] = '2007-01-01 00:00:00 +0000'
+
+def git(repo, *args, **kwargs):
+    proc = subprocess.Popen(['git', '--git-dir=' + repo] + list(args),
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out = proc.communicate(kwargs.get('input'))[0]
+    assert proc.returncode == 0
+    return out
+
+class spoolingstore(object):
+    """Object store whose add_thin_pack() reads the pack itself, as in
+    dulwich 0.9 and later."""
+    def __init__(self, store):
+        self.store = store
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def add_thin_pack(self, read_all, read_some):
+        f, commit = self.store.add_thin_pack()
+        f.write(read_all())
+        return commit()
+
+class writingstore(object):
+    """Object store whose add_thin_pack() returns a file to write the pack
+    to, as in dulwich before 0.9."""
+    def __init__(self, store):
+        self.store = store
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def add_thin_pack(self):
+        f = tempfile.TemporaryFile(dir=self.store.pack_dir)
+        def commit():
+            f.seek(0)
+            try:
+                return self.store.add_thin_pack(f.read, None)
+            finally:
+                f.close()
+        return f, commit
+
+class TestThinFetch(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp('hg-git_thin-fetch-test')
+        hgrepo = os.path.join(self.tmpdir, 'hgrepo')
+        commands.init(ui.ui(), hgrepo)
+        self.ui = ui.ui()
+        self.handler = GitHandler(hg.repository(self.ui, hgrepo), self.ui)
+        self.handler.init_if_missing()
+        self.store = self.handler.git.object_store
+
+        # a remote with two commits; we have the first one already
+        remote = os.path.join(self.tmpdir, 'remote')
+        git(remote, 'init', '-q', '--bare')
+        data = ''.join('line %d\n' % i for i in range(100))
+        first = self.commit(remote, data, [])
+        second = self.commit(remote, data + 'line 100\n', [first])
+        self.fetch(git(remote, 'pack-objects', '--revs', '--stdout',
+                       input=first + '\n'))
+        self.thin = git(remote, 'pack-objects', '--revs', '--thin',
+                        '--stdout', input='%s\n^%s\n' % (second, first))
+        self.second = second
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertEquals(self, l, r):
+        print '%% expect %r' % (r, )
+        print l
+        assert l == r
+
+    def commit(self, repo, data, parents):
+        blob = git(repo, 'hash-object', '-w', '--stdin', input=data).strip()
+        tree = git(repo, 'mktree', input='100644 blob %s\tfile\n' % blob)
+        args = ['commit-tree', tree.strip()]
+        for p in parents:
+            args += ['-p', p]
+        return git(repo, *args, input='commit\n').strip()
+
+    def fetch(self, pack):
+        f, commit = self.handler.add_fetched_pack()
+        f.write(pack)
+        commit()
+
+    def check(self):
+        store = self.store
+        count = struct.unpack('>L', self.thin[8:12])[0]
+        before = len(list(store.packs))
+        self.fetch(self.thin)
+        packs = list(store.packs)
+        self.assertEquals(len(packs), before + 1)
+        # the base of the new file version was added to the pack
+        self.assertEquals([len(p) for p in packs if len(p) != 3],
+                          [count + 1])
+        tree = store[store[self.second].tree]
+        blob = store[tree['file'][1]]
+        self.assertEquals(blob.data.splitlines()[-2:],
+                          ['line 99', 'line 100'])
+
+    def test_thin_fetch(self):
+        self.check()
+
+    def test_thin_fetch_other(self):
+        # the other way dulwich may take a thin pack
+        if inspect.getargspec(self.store.add_thin_pack)[0][1:]:
+            self.handler.git.object_store = writingstore(self.store)
+        else:
+            self.handler.git.object_store = spoolingstore(self.store)
+        self.check()
+
+if __name__ == '__main__':
+    tc = TestThinFetch()
+    for test in ['test_thin_fetch',
+                 'test_thin_fetch_other']:
+        tc.setUp()
+        getattr(tc, test)()
+        tc.tearDown()